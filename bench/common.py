@@ -0,0 +1,135 @@
+"""Helpers shared by benchmark scripts: make package importable from source
+   tree and generate synthetic metric result messages."""
+
+import datetime
+import imp
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    import argo_egi_consumer
+except ImportError:
+    sys.modules['argo_egi_consumer'] = imp.load_module('argo_egi_consumer', None,
+                                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'),
+                                                       ('', '', imp.PKG_DIRECTORY))
+
+from argo_egi_consumer.config import ConsumerConf
+from argo_egi_consumer.shared import SingletonShared as Shared
+
+ETCDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etc')
+
+class Logger:
+    def __init__(self, quiet=True):
+        self.quiet = quiet
+
+    def _log(self, level, msg):
+        if not self.quiet or level == 'ERROR':
+            sys.stderr.write('%s %s\n' % (level, msg))
+
+    def error(self, msg):
+        self._log('ERROR', msg)
+
+    def warning(self, msg):
+        self._log('WARNING', msg)
+
+    def info(self, msg):
+        self._log('INFO', msg)
+
+def setup(outdir, options=None, quiet=True):
+    """Write config based on etc/consumer.conf with output in outdir and
+       options, dict of section and dict of option and value, overriden.
+       Option with None value is removed. Shared state is set up as daemon
+       would do it."""
+    confpath = os.path.join(outdir, 'consumer.conf')
+    sections, section = [], None
+    for line in open(os.path.join(ETCDIR, 'consumer.conf')):
+        line = line.rstrip('\n').replace('/var/lib/argo-egi-consumer', outdir)
+        line = line.replace('/etc/argo-egi-consumer', ETCDIR)
+        if line.startswith('['):
+            section = (line.strip('[]'), [])
+            sections.append(section)
+        elif section and '=' in line:
+            section[1].append([s.strip() for s in line.split('=', 1)])
+    for name, opts in (options or {}).items():
+        sect = [s for s in sections if s[0] == name]
+        if not sect:
+            sect = [(name, [])]
+            sections.append(sect[0])
+        for opt, val in opts.items():
+            existing = [o for o in sect[0][1] if o[0] == opt]
+            if val is None:
+                for o in existing:
+                    sect[0][1].remove(o)
+            elif existing:
+                existing[0][1] = str(val)
+            else:
+                sect[0][1].append([opt, str(val)])
+    conf = open(confpath, 'w')
+    for name, opts in sections:
+        conf.write('[%s]\n' % name)
+        conf.write(''.join(['%s = %s\n' % (o, v) for o, v in opts]) + '\n')
+    conf.close()
+
+    # Shared instance copies what was set when it was created, so the one
+    # returned is created once everything is set
+    sh = Shared()
+    sh.seta('Logger', Logger(quiet))
+    sh.seta('eventusr1', threading.Event())
+    sh.seta('eventterm', threading.Event())
+    sh.seta('nummsg', 0)
+    sh.seta('stime', time.time())
+    sh.seta('ConsumerConf', ConsumerConf(confpath))
+    Shared.ConsumerConf.parse()
+    return Shared()
+
+SERVICES = ['CREAM-CE', 'SRM', 'SRMv2', 'ARC-CE', 'Site-BDII', 'SRM,SRMv2', 'eu.egi.cloud.vm-management.occi']
+STATUSES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+WORDS = ['job', 'submitted', 'to', 'queue', 'status', 'DONE-OK', 'exit', 'code',
+         'lcg-cr', 'timeout', 'proxy', 'valid', 'for', 'hours', 'CE', 'glite-ce-job-submit']
+
+def details(rnd, size):
+    words = []
+    while sum([len(w) + 1 for w in words]) < size:
+        words.append(rnd.choice(WORDS))
+    # detailsData of real results holds escaped newlines and occasionally
+    # continuation lines without key
+    text = ' '.join(words)
+    return '\\n'.join([text[i:i+80] for i in range(0, len(text), 80)])
+
+def message(rnd, i, detailsize=1024, timestamp=None):
+    ts = timestamp or datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    headers = {'message-id': 'ID:bench-%d' % i, 'destination': '/topic/grid.probe.metricOutput.EGEE.ngi.NGI_HR',
+               'timestamp': '1444120000000', 'expires': '0', 'priority': '4'}
+    body = ('serviceType: %s\n'
+            'metricStatus: %s\n'
+            'timestamp: %s\n'
+            'hostName: host%d.example.org\n'
+            'metricName: org.sam.CREAMCE-JobSubmit-/ops/Role=lcgadmin\n'
+            'summaryData: %s - job submitted \xc5\xa1\n'
+            'detailsData: %s\n'
+            'continuation line of details\n'
+            'nagios_host: mon.example.org\n'
+            'ROC: NGI_HR\n'
+            'voName: ops\n'
+            'voFqan: /ops/Role=lcgadmin\n'
+            'EOT\n') % (rnd.choice(SERVICES), rnd.choice(STATUSES), ts, i % 5000,
+                        rnd.choice(STATUSES), details(rnd, detailsize))
+    return headers, body
+
+SIZEDISTS = ['uniform', 'fixed', 'lognormal']
+
+def detailsizes(rnd, detailsize, dist):
+    if dist == 'fixed':
+        return detailsize
+    elif dist == 'lognormal':
+        # few results carry long job outputs in detailsData
+        return min(int(rnd.lognormvariate(math.log(detailsize), 1.0)), 64*1024)
+    return rnd.randint(detailsize/4, detailsize*2)
+
+def messages(n, detailsize=1024, seed=42, dist='uniform'):
+    rnd = random.Random(seed)
+    return [message(rnd, i, detailsizes(rnd, detailsize, dist)) for i in range(n)]
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+"""End-to-end benchmark: synthetic metric results are replayed by the
+   in-process fake broker into real MessageReader, MessagePipeline and
+   MessageWriter. Reported per configuration are messages per second from
+   first publish until last message is written by the writer, p50/p99
+   latency from receive in listener until the block holding message is
+   flushed to day file, CPU time (broker and replayer included, they run
+   in the same process) and RSS.
+
+   Every configuration runs in its own process. Results can be saved with
+   --json and compared with earlier ones with --baseline, exit status is 1
+   if throughput of any configuration dropped more than --tolerance."""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import common
+from fakebroker import FakeBroker, Replayer
+
+DESTINATIONS = ['/topic/grid.probe.metricOutput.EGEE.ngi.NGI_HR',
+                '/topic/grid.probe.metricOutput.EGEE.roc.CE',
+                '/topic/grid.probe.metricOutput.EGEE.opsmonitor.ops',
+                '/topic/grid.probe.metricOutput.EGEE.project.egi']
+
+def rss():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+    return 0
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+def overrides(args):
+    options = {}
+    for item in args.set or []:
+        key, val = item.split('=', 1)
+        section, opt = key.split('.', 1)
+        options.setdefault(section, {})[opt] = val
+    return options
+
+def single(args):
+    logging.getLogger('stomp.py').addHandler(logging.NullHandler())
+    outdir = tempfile.mkdtemp(prefix='e2e_bench')
+    broker = FakeBroker()
+    options = {'Brokers': {'Server1': '%s:%d' % (broker.host, broker.port), 'Server2': None},
+               'STOMP': {'AckMode': args.ackmode, 'ReconnectAttempts': 1},
+               'Subscription': {'Connections': args.connections},
+               'Queue': {'WriterThreads': args.writerthreads}}
+    for section, opts in overrides(args).items():
+        options.setdefault(section, {}).update(opts)
+    sh = common.setup(outdir, options)
+
+    from argo_egi_consumer.reader import MessageReader
+    reader = MessageReader()
+    pipeline = reader.pipeline
+    latencies, written = [], []
+    put, durable = pipeline.put, pipeline.durable
+    writeframes = pipeline.writer.writeFrames
+
+    def timedput(headers, message, token):
+        token = token or {'slot': None}
+        token['recv'] = time.time()
+        put(headers, message, token)
+
+    def timeddurable(tokens):
+        now = time.time()
+        latencies.extend([now - token['recv'] for token in tokens if token and 'recv' in token])
+        durable(tokens)
+
+    def countedwrite(frames, *args):
+        writeframes(frames, *args)
+        written.append(len(frames))
+
+    pipeline.put = timedput
+    pipeline.writer.writeFrames = countedwrite
+    pipeline.durable = timeddurable
+    pipeline.writer.setDurableCallback(timeddurable)
+
+    th = threading.Thread(target=reader.run, name='reader_thread')
+    th.daemon = True
+    th.start()
+    deadline = time.time() + 30
+    while broker.nsubscribers() < len(DESTINATIONS) and time.time() < deadline:
+        time.sleep(0.05)
+
+    msgs = [(DESTINATIONS[i % len(DESTINATIONS)], body) for i, (headers, body) in
+            enumerate(common.messages(args.messages, args.detailsize, dist=args.sizedist))]
+    rssbefore = rss()
+    cpubefore = resource.getrusage(resource.RUSAGE_SELF)
+    replayer = Replayer(broker, msgs, args.rate)
+    replayer.start()
+    deadline = time.time() + args.timeout
+    while sum(written) < len(msgs) and time.time() < deadline:
+        time.sleep(0.01)
+    dur = time.time() - replayer.tstart
+    cpuafter = resource.getrusage(resource.RUSAGE_SELF)
+    rssafter = rss()
+    # last blocks are flushed only after FlushEverySeconds
+    while len(latencies) < len(msgs) and time.time() < deadline:
+        time.sleep(0.01)
+
+    sh.eventterm.set()
+    reader.close()
+    broker.stop()
+    th.join(5)
+    if hasattr(pipeline.writer, 'pool'):
+        pipeline.writer.pool.th.join(5)
+    shutil.rmtree(outdir)
+
+    latencies.sort()
+    cpu = (cpuafter.ru_utime - cpubefore.ru_utime) + (cpuafter.ru_stime - cpubefore.ru_stime)
+    return {'ackmode': args.ackmode, 'connections': args.connections,
+            'writerthreads': args.writerthreads, 'rate': args.rate,
+            'messages': len(msgs), 'written': sum(written), 'flushed': len(latencies),
+            'acked': broker.nacked, 'ackframes': broker.nackframes,
+            'msgs_per_sec': sum(written) / dur,
+            'p50_ms': 1000 * percentile(latencies, 0.50),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+            'cpu_sec': cpu, 'cpu_pct': 100 * cpu / dur,
+            'rss_kb': rssafter, 'rss_growth_kb': rssafter - rssbefore,
+            'maxrss_kb': cpuafter.ru_maxrss}
+
+def configkey(result):
+    return '%s/conns=%d/threads=%d/rate=%d' % (result['ackmode'], result['connections'],
+                                               result['writerthreads'], result['rate'])
+
+def report(result):
+    line = ('%-40s %9.0f msgs/s p50 %8.1f ms p99 %8.1f ms cpu %5.1f%% rss %7d KB flushed %d/%d' %
+            (configkey(result), result['msgs_per_sec'], result['p50_ms'], result['p99_ms'],
+             result['cpu_pct'], result['rss_kb'], result['flushed'], result['messages']))
+    print line
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--detailsize', type=int, default=1024)
+    parser.add_argument('--sizedist', choices=common.SIZEDISTS, default='uniform')
+    parser.add_argument('--rate', type=int, default=0, help='messages per second, 0 as fast as possible')
+    parser.add_argument('--timeout', type=int, default=300)
+    parser.add_argument('--ackmodes', nargs='+', default=['auto', 'client', 'client-individual'])
+    parser.add_argument('--connections', type=int, nargs='+', default=[1])
+    parser.add_argument('--writerthreads', type=int, nargs='+', default=[1])
+    parser.add_argument('--set', action='append', metavar='SECTION.OPTION=VALUE',
+                        help='override config option, can be given more times')
+    parser.add_argument('--json', help='save results to file')
+    parser.add_argument('--baseline', help='compare with results saved with --json')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--ackmode', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        args.connections, args.writerthreads = args.connections[0], args.writerthreads[0]
+        print json.dumps(single(args))
+        return
+
+    baseline = {}
+    if args.baseline:
+        baseline = dict([(configkey(r), r) for r in json.load(open(args.baseline))])
+
+    results, regressed = [], []
+    for ackmode, conns, threads in itertools.product(args.ackmodes, args.connections, args.writerthreads):
+        cmd = [sys.executable, os.path.abspath(__file__), '--single', '--ackmode', ackmode,
+               '--connections', str(conns), '--writerthreads', str(threads),
+               '--messages', str(args.messages), '--detailsize', str(args.detailsize),
+               '--sizedist', args.sizedist, '--rate', str(args.rate), '--timeout', str(args.timeout)]
+        for item in args.set or []:
+            cmd.extend(['--set', item])
+        out = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+        result = json.loads(out.strip().split('\n')[-1])
+        results.append(result)
+        report(result)
+        base = baseline.get(configkey(result))
+        if base and result['msgs_per_sec'] < (1 - args.tolerance) * base['msgs_per_sec']:
+            regressed.append(configkey(result))
+            print '%-40s regressed from %.0f msgs/s' % ('', base['msgs_per_sec'])
+
+    if args.json:
+        json.dump(results, open(args.json, 'w'), indent=2)
+    if regressed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+"""Encode metric results with generic DatumWriter and with encoder compiled
+   by avroencoder. Output of compiled encoder is first checked to be byte
+   identical to generic one for every record, also for results with
+   optional fields missing and non-ASCII text, then records per second of
+   both are compared."""
+
+import argparse
+import cStringIO
+import sys
+import time
+
+import common
+from argo_egi_consumer import avroencoder
+from argo_egi_consumer import msgparser
+from avro.io import BinaryEncoder
+from avro.io import DatumWriter
+import avro.schema
+
+def views(msgs):
+    out = []
+    for headers, body in msgs:
+        out.extend(msgparser.parse(headers, body).services())
+    return out
+
+def edgecases(views):
+    """Views of copies of first results with optional fields unset, empty
+       and non-ASCII values."""
+    out = []
+    for i, view in enumerate(views[:4]):
+        result = view.result
+        if i == 0:
+            result.summaryData, result.detailsData, result.nagios_host = None, None, None
+        elif i == 1:
+            result.summaryData, result.detailsData = u'', u'\u0161\u0111\u010d ' * 500
+        elif i == 2:
+            result.hostName = u'\u010dvor.example.org'
+        out.append(view)
+    return out
+
+def generic(writer, records):
+    buf = cStringIO.StringIO()
+    encoder = BinaryEncoder(buf)
+    out = []
+    for r in records:
+        start = buf.tell()
+        writer.write_data(writer.writers_schema, r, encoder)
+        out.append(buf.getvalue()[start:])
+    return out
+
+def timed(func, records, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func(records)
+    return repeat * len(records) / (time.time() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--detailsize', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--schema', default=common.ETCDIR + '/metric_data.avsc')
+    args = parser.parse_args()
+
+    schema = avro.schema.parse(open(args.schema).read())
+    encode = avroencoder.compile(schema)
+    if not encode:
+        print 'schema %s not supported by compiled encoder' % args.schema
+        raise SystemExit(1)
+    writer = DatumWriter(schema)
+    records = views(common.messages(args.messages, args.detailsize))
+    checked = edgecases(views(common.messages(4, args.detailsize, seed=7))) + records
+
+    mismatched = [i for i, (a, b) in enumerate(zip(generic(writer, checked), map(encode, checked))) if a != b]
+    if mismatched:
+        print 'compiled encoder output differs for %d of %d records' % (len(mismatched), len(checked))
+        raise SystemExit(1)
+    print 'compiled encoder output identical for %d records' % len(checked)
+    sys.stdout.flush()
+
+    rgeneric = timed(lambda recs: generic(writer, recs), records, args.repeat)
+    rcompiled = timed(lambda recs: [encode(r) for r in recs], records, args.repeat)
+    print '%-8s %10.0f records/s' % ('generic', rgeneric)
+    print '%-8s %10.0f records/s %5.1fx' % ('compiled', rcompiled, rcompiled / rgeneric)
+
+if __name__ == '__main__':
+    main()
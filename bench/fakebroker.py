@@ -0,0 +1,209 @@
+"""In-process stand-in for STOMP 1.0/1.1 broker. Understands only what the
+   consumer uses: CONNECT, SUBSCRIBE with ActiveMQ style wildcard
+   destinations, ACK in auto, client and client-individual mode and
+   DISCONNECT with receipt. Replayer publishes messages at given rate."""
+
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+class Subscription:
+    def __init__(self, client, headers):
+        self.client = client
+        self.id = headers.get('id')
+        self.destination = headers['destination']
+        self.ack = headers.get('ack', 'auto')
+        self.unacked = OrderedDict()
+        self._parts = self.destination.split('.')
+
+    def matches(self, destination):
+        parts = destination.split('.')
+        for i, part in enumerate(self._parts):
+            if part == '>':
+                return True
+            if i >= len(parts) or (part != '*' and part != parts[i]):
+                return False
+        return len(parts) == len(self._parts)
+
+class Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.version = '1.0'
+        self.alive = True
+
+    def send(self, frame):
+        self.lock.acquire()
+        try:
+            if self.alive:
+                self.sock.sendall(frame)
+        except socket.error:
+            self.alive = False
+        finally:
+            self.lock.release()
+
+class FakeBroker:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(16)
+        self.host, self.port = self.sock.getsockname()
+        self.subs = []
+        self.lock = threading.Lock()
+        self._ids = itertools.count()
+        self.nsent, self.nacked, self.nackframes = 0, 0, 0
+        self._running = True
+        # heart-beat header of CONNECTED, broker never sends heart-beats so
+        # anything but 0 in second field makes client time out
+        self.heartbeat = '0,0'
+        th = threading.Thread(target=self._accept, name='fakebroker_accept')
+        th.daemon = True
+        th.start()
+
+    def _accept(self):
+        while self._running:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            th = threading.Thread(target=self._serve, args=(Client(sock),), name='fakebroker_client')
+            th.daemon = True
+            th.start()
+
+    def _frames(self, client):
+        buf = ''
+        while True:
+            try:
+                data = client.sock.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+            buf += data
+            while '\x00' in buf:
+                frame, buf = buf.split('\x00', 1)
+                frame = frame.lstrip('\r\n')
+                if frame:
+                    head = frame.split('\n\n', 1)[0].split('\n')
+                    yield head[0], dict([line.split(':', 1) for line in head[1:] if ':' in line])
+
+    def _serve(self, client):
+        for command, headers in self._frames(client):
+            if command in ('CONNECT', 'STOMP'):
+                if '1.1' in headers.get('accept-version', '').split(','):
+                    client.version = '1.1'
+                client.send('CONNECTED\nsession:fakebroker-%d\nversion:%s\nheart-beat:%s\n\n\x00' %
+                            (next(self._ids), client.version, self.heartbeat))
+            elif command == 'SUBSCRIBE':
+                self.lock.acquire()
+                self.subs.append(Subscription(client, headers))
+                self.lock.release()
+            elif command == 'UNSUBSCRIBE':
+                self._drop(lambda sub: sub.client is client and
+                           (sub.id == headers.get('id') or sub.destination == headers.get('destination')))
+            elif command == 'ACK':
+                self._ack(client, headers)
+            elif command == 'DISCONNECT':
+                if 'receipt' in headers:
+                    client.send('RECEIPT\nreceipt-id:%s\n\n\x00' % headers['receipt'])
+                break
+        client.alive = False
+        self._drop(lambda sub: sub.client is client)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def _drop(self, pred):
+        self.lock.acquire()
+        self.subs = [sub for sub in self.subs if not pred(sub)]
+        self.lock.release()
+
+    def _ack(self, client, headers):
+        msgid = headers.get('message-id')
+        self.lock.acquire()
+        try:
+            self.nackframes += 1
+            for sub in self.subs:
+                if sub.client is not client or msgid not in sub.unacked:
+                    continue
+                if sub.ack == 'client':
+                    while sub.unacked.popitem(last=False)[0] != msgid:
+                        self.nacked += 1
+                else:
+                    del sub.unacked[msgid]
+                self.nacked += 1
+        finally:
+            self.lock.release()
+
+    def nsubscribers(self):
+        self.lock.acquire()
+        try:
+            return len(self.subs)
+        finally:
+            self.lock.release()
+
+    def publish(self, destination, body, headers=None):
+        """Send message to every matching subscription, return number of
+           subscriptions it was sent to."""
+        msgid = 'ID:fakebroker-%d' % next(self._ids)
+        extra = ''.join(['%s:%s\n' % (k, v) for k, v in (headers or {}).items()])
+        self.lock.acquire()
+        subs = [sub for sub in self.subs if sub.matches(destination)]
+        for sub in subs:
+            if sub.ack != 'auto':
+                sub.unacked[msgid] = True
+        self.lock.release()
+        for sub in subs:
+            subhdr = 'subscription:%s\n' % sub.id if sub.id is not None else ''
+            sub.client.send('MESSAGE\ndestination:%s\nmessage-id:%s\n%stimestamp:%d\n%scontent-length:%d\n\n%s\x00' %
+                            (destination, msgid, subhdr, int(time.time()*1000), extra, len(body), body))
+        self.nsent += len(subs)
+        return len(subs)
+
+    def stop(self):
+        self._running = False
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.lock.acquire()
+        clients = set([sub.client for sub in self.subs])
+        self.lock.release()
+        for client in clients:
+            client.alive = False
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class Replayer:
+    """Publish (destination, body) messages at rate messages per second,
+       as fast as possible if rate is 0."""
+    def __init__(self, broker, messages, rate=0):
+        self.broker = broker
+        self.messages = messages
+        self.rate = rate
+        self.npublished = 0
+        self.th = threading.Thread(target=self._replay, name='fakebroker_replayer')
+        self.th.daemon = True
+
+    def start(self):
+        self.tstart = time.time()
+        self.th.start()
+
+    def _replay(self):
+        for i, (destination, body) in enumerate(self.messages):
+            if self.rate:
+                delay = self.tstart + float(i)/self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.broker.publish(destination, body)
+            self.npublished += 1
+
+    def join(self, timeout=None):
+        self.th.join(timeout)
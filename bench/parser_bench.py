@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+"""Microbenchmark of message body parsing: fast path msgparser.parse and
+   msgparser.parsefull against the per-line parser previously used in
+   DestListener.on_message."""
+
+import argparse
+import timeit
+
+import common
+from argo_egi_consumer import msgparser
+
+def legacy_parse(headers, message):
+    lines = message.split('\n')
+    fields = dict()
+
+    #header fields
+    fields.update(headers)
+    # body fields
+    for line in lines:
+        splitLine = line.split(': ', 1)
+        if len(splitLine) > 1:
+            key = splitLine[0]
+            value = splitLine[1]
+            fields[key] = value.decode('utf-8', 'replace')
+
+    return fields
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--detailsize', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    msgs = common.messages(args.messages, args.detailsize)
+    for h, b in msgs:
+        full = legacy_parse(h, b)
+        assert msgparser.parsefull(h, b) == full
+        result = msgparser.parse(h, b)
+        assert result.msgid == full['message-id']
+        for key in msgparser.MANDATORY + msgparser.OPTIONAL:
+            assert getattr(result, key) == full.get(key)
+
+    results = {}
+    for name, func in [('legacy', legacy_parse),
+                       ('parsefull', msgparser.parsefull),
+                       ('parse', msgparser.parse)]:
+        best = min(timeit.repeat(lambda: [func(h, b) for h, b in msgs],
+                                 repeat=args.repeat, number=1))
+        results[name] = best
+        print '%-10s %10.0f msg/s %8.2f us/msg' % (name, args.messages/best, 1e6*best/args.messages)
+    print 'parse speedup over legacy: %.2fx' % (results['legacy']/results['parse'])
+
+if __name__ == '__main__':
+    main()
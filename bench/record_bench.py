@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""Compare per-message dicts previously built for Avro encoding with
+   MetricResult and its ServiceViews: memory held per in-flight result,
+   build time and number of objects tracked by garbage collector."""
+
+import argparse
+import gc
+import sys
+import time
+
+import common
+from argo_egi_consumer import msgparser
+from parser_bench import legacy_parse
+
+def legacy_records(fields):
+    msglist = []
+    msg, tags = {}, {}
+
+    msg = {'service': fields['serviceType'],
+           'timestamp': fields['timestamp'],
+           'hostname': fields['hostName'],
+           'metric': fields['metricName'],
+           'status': fields['metricStatus']}
+    msgattrmap = {'detailsData': 'message',
+                  'summaryData': 'summary',
+                  'nagios_host': 'monitoring_host'}
+    for attr in msgattrmap.keys():
+        if attr in fields:
+            msg[msgattrmap[attr]] = fields[attr]
+
+    tagattrmap = {'ROC': 'roc', 'voName': 'voName', 'voFqan': 'voFqan'}
+    for attr in tagattrmap.keys():
+        tags[tagattrmap[attr]] = fields.get(attr, None)
+    if tags:
+        msg['tags'] = tags
+
+    if ',' in fields['serviceType']:
+        servtype = fields['serviceType'].split(',')
+        msg['service'] = servtype[0].strip()
+        msglist.append(msg)
+        copymsg = msg.copy()
+        copymsg['service'] = servtype[1].strip()
+        msglist.append(copymsg)
+    else:
+        msglist.append(msg)
+
+    return fields, msglist
+
+def new_records(headers, body):
+    result = msgparser.parse(headers, body)
+    views = result.services()
+    result.tags()
+    return result, views
+
+def containers(obj):
+    """Size of container objects only, strings are shared by both."""
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum([containers(v) for v in obj.values()])
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum([containers(v) for v in obj])
+    elif isinstance(obj, msgparser.MetricResult):
+        return sys.getsizeof(obj) + containers(obj._tags)
+    elif isinstance(obj, msgparser.ServiceView):
+        return sys.getsizeof(obj)
+    return 0
+
+def run(name, build, msgs):
+    gc.collect()
+    start = time.time()
+    held = [build(h, b) for h, b in msgs]
+    dur = time.time() - start
+    objects = len(gc.get_objects())
+    del held
+    gc.collect()
+    objects -= len(gc.get_objects())
+    size = sum([containers(build(h, b)) for h, b in msgs]) / float(len(msgs))
+    print '%-8s %8.2f us/msg %8.0f bytes/msg in containers %6.1f gc tracked objects/msg' % \
+        (name, 1e6*dur/len(msgs), size, objects/float(len(msgs)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--detailsize', type=int, default=1024)
+    args = parser.parse_args()
+
+    msgs = common.messages(args.messages, args.detailsize)
+    run('legacy', lambda h, b: legacy_records(legacy_parse(h, b)), msgs)
+    run('result', new_records, msgs)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+"""Append batches of records to Avro day files from several threads with
+   all appends serialized by one global lock, as writer path did with
+   thlock, and with per day file locks only. With --stall, every block
+   written to the first day file takes that many ms longer, as on slow
+   disk, and the first thread writes only to it. Throughput is then
+   reported for the other threads writing to the other day files, which
+   shows whether slow file holds them up. With --codecs, throughput and
+   bytes per record written with every given codec are compared."""
+
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import common
+from argo_egi_consumer import msgparser
+
+def batches(msgs, batchsize):
+    views = []
+    for headers, body in msgs:
+        views.extend(msgparser.parse(headers, body).services())
+    return [views[i:i+batchsize] for i in range(0, len(views), batchsize)]
+
+def run(name, nthreads, nfiles, recbatches, outdir, globallock, codec=None, blocksize=None, stall=0):
+    from argo_egi_consumer.writer import AvroWriterPool
+    pool = AvroWriterPool()
+    pool.codec = codec or pool.codec
+    pool.blockSize = blocksize or pool.blockSize
+    lock = threading.Lock()
+    files = ['%s/day%d.avro' % (outdir, i) for i in range(nfiles)]
+    ends = [None] * nthreads
+
+    if stall:
+        writeblock = pool._writeblock
+        def slowwriteblock(ent, flush):
+            if ent['path'] == files[0]:
+                time.sleep(stall / 1000.0)
+            writeblock(ent, flush)
+        pool._writeblock = slowwriteblock
+
+    def pick(t, i):
+        if not stall:
+            return files[(t + i) % nfiles]
+        elif t == 0:
+            return files[0]
+        return files[1 + (t + i) % (nfiles - 1)]
+
+    def worker(t):
+        for i, batch in enumerate(recbatches):
+            log = pick(t, i)
+            if globallock:
+                lock.acquire()
+                try:
+                    pool.append({log: batch})
+                finally:
+                    lock.release()
+            else:
+                pool.append({log: batch})
+        ends[t] = time.time()
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(nthreads)]
+    start = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    pool.close()
+    dur = time.time() - start
+    nrecs = nthreads * sum([len(b) for b in recbatches])
+    if stall:
+        others = nrecs - sum([len(b) for b in recbatches])
+        print '%-8s threads=%d files=%d stall=%d ms %10.0f records/s to other files' % \
+            (name, nthreads, nfiles, stall, others/(max(ends[1:]) - start))
+        return pool
+    size = sum([os.path.getsize(f) for f in files if os.path.exists(f)])
+    print '%-8s threads=%d files=%d %10.0f records/s %8.1f bytes/record' % (name, nthreads, nfiles, nrecs/dur,
+                                                                          float(size)/nrecs)
+    return pool
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--detailsize', type=int, default=1024)
+    parser.add_argument('--batchsize', type=int, default=100)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--codecs', nargs='+')
+    parser.add_argument('--blocksize', type=int)
+    parser.add_argument('--stall', type=int, default=0)
+    args = parser.parse_args()
+    if args.stall and (args.files < 2 or min(args.threads) < 2):
+        parser.error('--stall needs at least 2 files and 2 threads')
+
+    recbatches = batches(common.messages(args.messages, args.detailsize), args.batchsize)
+    basedir = tempfile.mkdtemp(prefix='writer_bench')
+    sh = common.setup(basedir)
+    pools = []
+    try:
+        if args.codecs:
+            for codec in args.codecs:
+                outdir = tempfile.mkdtemp(dir=basedir)
+                pools.append(run(codec, 1, args.files, recbatches, outdir, False, codec, args.blocksize))
+            return
+        for nthreads in args.threads:
+            for name, globallock in [('global', True), ('perfile', False)]:
+                outdir = tempfile.mkdtemp(dir=basedir)
+                pools.append(run(name, nthreads, args.files, recbatches, outdir, globallock,
+                                 blocksize=args.blocksize, stall=args.stall))
+    finally:
+        sh.eventterm.set()
+        for pool in pools:
+            pool.th.join(5)
+        shutil.rmtree(basedir)
+
+if __name__ == '__main__':
+    main()
@@ -160,38 +160,28 @@ class Daemon:
         def sigtermcleanup(signum, frame):
             sh.Logger.info('Caught SIGTERM')
             sh.eventterm.set()
-            try:
-                self.reader.conn.stop()
-                self.reader.conn.disconnect()
-            except stomp.exception.NotConnectedException:
-                sh.Logger.info('Disconnected: %s:%i' % (self.reader.server[0], self.reader.server[1]))
-                raise SystemExit(3)
+            self.reader.close()
+            raise SystemExit(3)
 
         signal.signal(signal.SIGTERM, sigtermcleanup)
 
         def sigintcleanup(signum, frame):
             sh.Logger.info('Caught SIGINT')
-            try:
-                self.reader.conn.stop()
-                self.reader.conn.disconnect()
-            except stomp.exception.NotConnectedException:
-                sh.Logger.info('Disconnected: %s:%i' % (self.reader.server[0], self.reader.server[1]))
-                raise SystemExit(3)
+            self.reader.close()
+            raise SystemExit(3)
 
         signal.signal(signal.SIGINT, sigintcleanup)
 
         def sigusr1handle(signum, frame):
             sh.Logger.info('Caught SIGUSR1')
             sh.eventusr1.set()
+            self.reader.wake()
 
         signal.signal(signal.SIGUSR1, sigusr1handle)
 
         def sighuphandle(signum, frame):
             sh.Logger.info('Caught SIGHUP')
-            self.reader.load()
-            self.reader.listener.load()
-            self.reader.listener.writer.load()
-            sh.Logger.info('Config reload')
+            self.reader.reload()
 
         signal.signal(signal.SIGHUP, sighuphandle)
 
@@ -260,7 +250,7 @@ class Daemon:
 
     def _run(self):
         self.reader = MessageReader()
-        sh.Logger.info("Started")
+        sh.Logger.info("Started, config parsed in %.1f ms" % (1000 * sh.ConsumerConf.snapshot().loadtime))
         sh.seta('stime', time.time())
         self.reader.run()
 
@@ -275,14 +265,15 @@ def main():
     parser.add_argument('--status', action='store_true')
     args = parser.parse_args()
 
+    # errors of config are logged, logger is renamed once it is read
+    sh.seta('Logger', MsgLogger(os.path.basename(sys.argv[0])))
     sh.seta('ConsumerConf', ConsumerConf(args.config[0]))
     sh.ConsumerConf.parse()
     sh.seta('eventusr1', threading.Event())
     sh.seta('eventterm', threading.Event())
-    sh.seta('thlock', threading.Lock())
     clname = sh.ConsumerConf.get_option('GeneralLogName'.lower(), optional=True)
-    sh.seta('Logger', MsgLogger(clname if clname else os.path.basename(sys.argv[0])))
-    sh.seta('nummsg', 0)
+    if clname:
+        sh.Logger.rename(clname)
     md = hashlib.md5()
     md.update(args.config[0])
     daemon = Daemon(pidfile % md.hexdigest(), name=daemonname, nofork=args.nofork)
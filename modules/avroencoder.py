@@ -0,0 +1,135 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+"""Encoder generated from Avro record schema made of string fields, unions
+   of null and string, maps of those and unions of null and such map, the
+   shape of metric_data.avsc. It writes the same bytes as DatumWriter
+   without walking the schema and validating unions for every datum."""
+
+VARINTCACHE = 4096
+
+def _varint(n):
+    """Zig-zag varint of non-negative n as BinaryEncoder.write_long."""
+    n <<= 1
+    out = []
+    while n & ~0x7F:
+        out.append(chr((n & 0x7F) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+VARINTS = [_varint(n) for n in range(VARINTCACHE)]
+
+_cache = {}
+
+def _nullable(schema, types):
+    """Index of null and of the other branch if schema is union of null
+       and one of types."""
+    if schema.type != 'union' or len(schema.schemas) != 2:
+        return None
+    kinds = [s.type for s in schema.schemas]
+    if 'null' not in kinds:
+        return None
+    other = 1 - kinds.index('null')
+    if kinds[other] not in types:
+        return None
+    return kinds.index('null'), other
+
+def _string(var, indent):
+    return [indent + '%s = %s.encode("utf-8")' % (var, var),
+            indent + 'n = len(%s)' % var,
+            indent + 'append(VARINTS[n] if n < VARINTCACHE else varint(n))',
+            indent + 'append(%s)' % var]
+
+def _value(schema, var, indent):
+    """Lines writing var of string or nullable string schema, None if
+       schema is of other shape."""
+    if schema.type == 'string':
+        return _string(var, indent)
+    branches = _nullable(schema, ('string',))
+    if not branches:
+        return None
+    return [indent + 'if %s is None:' % var,
+            indent + '    append(%r)' % _varint(branches[0]),
+            indent + 'else:',
+            indent + '    append(%r)' % _varint(branches[1])] + _string(var, indent + '    ')
+
+def _map(schema, var, indent):
+    values = _value(schema.values, 'v', indent + '        ')
+    if values is None:
+        return None
+    return [indent + 'if len(%s) > 0:' % var,
+            indent + '    append(varint(len(%s)))' % var,
+            indent + '    for k, v in %s.items():' % var] + \
+        _string('k', indent + '        ') + values + \
+        [indent + 'append("\\x00")']
+
+def _field(schema, var):
+    lines = _value(schema, var, '    ')
+    if lines is not None:
+        return lines
+    if schema.type == 'map':
+        return _map(schema, var, '    ')
+    branches = _nullable(schema, ('map',))
+    if branches:
+        lines = _map(schema.schemas[branches[1]], var, '        ')
+        if lines is not None:
+            return ['    if %s is None:' % var,
+                    '        append(%r)' % _varint(branches[0]),
+                    '    else:',
+                    '        append(%r)' % _varint(branches[1])] + lines
+    return None
+
+def source(schema):
+    """Python source of encode(datum) for record schema, None if schema is
+       not of supported shape."""
+    if schema.type != 'record':
+        return None
+    lines = ['def encode(datum):',
+             '    parts = []',
+             '    append = parts.append',
+             '    get = datum.get']
+    for field in schema.fields:
+        fieldlines = _field(field.type, 'f')
+        if fieldlines is None:
+            return None
+        lines.append('    f = get(%r)' % field.name)
+        lines.extend(fieldlines)
+    lines.append('    return "".join(parts)')
+    return '\n'.join(lines) + '\n'
+
+def compile(schema):
+    """Function encoding datum of schema to bytes, None if schema is not
+       supported. Compiled once per schema."""
+    key = str(schema)
+    if key not in _cache:
+        src = source(schema)
+        encode = None
+        if src is not None:
+            namespace = {'VARINTS': VARINTS, 'VARINTCACHE': VARINTCACHE, 'varint': _varint}
+            exec src in namespace
+            encode = namespace['encode']
+        _cache[key] = encode
+    return _cache[key]
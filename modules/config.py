@@ -1,114 +1,264 @@
 import ConfigParser
-import os, re, errno
+import os, re, errno, sys
 import logging
+import time
 from argo_egi_consumer.shared import SingletonShared as Shared
+from argo_egi_consumer import metrics
 
 sh = Shared()
 
+BOOLOPTIONS = ['GeneralLogMsgOutAllowedTime', 'GeneralLogWrongFormat',
+               'GeneralWritePlaintext', 'OutputIndex', 'DedupBloomFilter',
+               'STOMPUseSSL']
+INTOPTIONS = ['SubscriptionIdleMsgTimeout', 'SubscriptionConnections',
+              'STOMPTCPKeepAliveIdle', 'STOMPTCPKeepAliveInterval',
+              'STOMPTCPKeepAliveProbes', 'STOMPReconnectAttempts',
+              'STOMPHeartBeatSend', 'STOMPHeartBeatReceive',
+              'STOMPReconnectDelay', 'STOMPReconnectMaxDelay',
+              'MsgRetentionFutureDaysOK', 'MsgRetentionPastDaysOK',
+              'OutputFlushEveryRecords', 'OutputFlushEveryBytes',
+              'OutputFlushEverySeconds', 'OutputIdleFileTimeout',
+              'OutputFsyncEveryRecords', 'OutputFsyncEveryMs',
+              'OutputBlockSize', 'OutputMaxFileSize', 'QueueCapacity',
+              'QueueWriterThreads', 'WorkersProcesses', 'SpoolSyncInterval',
+              'SpoolSegmentSize', 'SpoolSegmentSeconds', 'DedupSize', 'DedupWindow',
+              'DedupBloomCapacity']
+FLOATOPTIONS = ['DedupBloomErrorRate']
+LISTOPTIONS = ['SubscriptionDestinations']
+TEMPLATEOPTIONS = ['OutputFilename', 'OutputErrorFilename']
+REQUIREDOPTIONS = ['GeneralAvroSchema', 'GeneralWritePlaintext',
+                   'GeneralLogMsgOutAllowedTime', 'GeneralLogWrongFormat',
+                   'SubscriptionDestinations', 'SubscriptionIdleMsgTimeout',
+                   'MsgRetentionPastDaysOk', 'MsgRetentionFutureDaysOk',
+                   'AuthenticationHostKey', 'AuthenticationHostCert',
+                   'STOMPUseSSL', 'STOMPTCPKeepAliveIdle', 'STOMPTCPKeepAliveInterval',
+                   'STOMPTCPKeepAliveProbes', 'STOMPReconnectAttempts',
+                   'OutputDirectory', 'OutputFilename', 'OutputErrorFilename']
+
+class ConfSnapshot:
+    """Options of one successful parse of config file, converted to their
+       types and validated. Snapshot is never changed once built, reload
+       builds a new one."""
+    def __init__(self, filename, options, loadtime):
+        self.filename = filename
+        self.loadtime = loadtime
+        self._options = options
+
+    def __contains__(self, opt):
+        return opt in self._options
+
+    def __getitem__(self, opt):
+        return self._options[opt]
+
+    def get(self, opt, default=None):
+        return self._options.get(opt, default)
+
+    def diff(self, other):
+        """Sorted options added, removed or changed in other snapshot."""
+        keys = set(self._options) | set(other._options)
+        return sorted([k for k in keys if self._options.get(k) != other._options.get(k)])
+
 class ConsumerConf:
     def __init__(self, confile):
-        self._options = {}
-        self._args = {'Output': ['Directory', 'Filename', 'ErrorFilename'],
+        self._snapshot = None
+        self._args = {'Output': ['Directory', 'Filename', 'ErrorFilename',
+                                 'FlushEveryRecords', 'FlushEveryBytes',
+                                 'FlushEverySeconds', 'IdleFileTimeout',
+                                 'FsyncPolicy', 'FsyncEveryRecords', 'FsyncEveryMs',
+                                 'Codec', 'BlockSize', 'Index', 'MaxFileSize',
+                                 'PlaintextCompression'],
                       'General': ['LogName', 'WritePlaintext', 'AvroSchema', 'Debug', 'LogMsgOutAllowedTime', 'LogWrongFormat', 'ReportWritMsgEveryHours'],
                       'MsgRetention': ['PastDaysOk', 'FutureDaysOk'],
-                      'Subscription': ['Destinations', 'IdleMsgTimeout'],
+                      'Subscription': ['Destinations', 'IdleMsgTimeout', 'Connections'],
                       'Authentication': ['HostKey', 'HostCert'],
                       'STOMP': ['TCPKeepAliveIdle', 'TCPKeepAliveInterval',
-                                'TCPKeepAliveProbes', 'ReconnectAttempts', 'UseSSL'],
-                      'Brokers': ['Server']}
+                                'TCPKeepAliveProbes', 'ReconnectAttempts', 'UseSSL',
+                                'AckMode', 'HeartBeatSend', 'HeartBeatReceive',
+                                'ReconnectDelay', 'ReconnectMaxDelay'],
+                      'Brokers': ['Server'],
+                      'Queue': ['Capacity', 'FullPolicy', 'SpillFile', 'WriterThreads'],
+                      'Spool': ['File', 'SyncInterval', 'SegmentSize', 'SegmentSeconds'],
+                      'Metrics': ['Listen'],
+                      'Workers': ['Processes', 'ShardBy'],
+                      'Dedup': ['Policy', 'Size', 'Window', 'BloomFilter', 'BloomCapacity', 'BloomErrorRate']}
         self._filename = confile
+        self._bools = set([o.lower() for o in BOOLOPTIONS])
+        self._ints = set([o.lower() for o in INTOPTIONS])
+        self._floats = set([o.lower() for o in FLOATOPTIONS])
+        self._lists = set([o.lower() for o in LISTOPTIONS])
+        self._templates = set([o.lower() for o in TEMPLATEOPTIONS])
+
+
+    def _error(self, msg):
+        """Config is parsed first before logger is set up, errors found
+           then go to stderr."""
+        if getattr(sh, 'Logger', None):
+            sh.Logger.error(repr(self.__class__) + ' %s' % msg)
+        else:
+            sys.stderr.write('%s %s\n' % (repr(self.__class__), msg))
+
+    def _convert(self, section, option, key, value, errors):
+        """Value of option in its type, None for empty one."""
+        if key in self._bools:
+            if value.lower() not in ConfigParser.RawConfigParser._boolean_states:
+                errors.append("Option %s in section [%s] should be True or False, not '%s'" % (option, section, value))
+                return None
+            return ConfigParser.RawConfigParser._boolean_states[value.lower()]
+        elif key in self._ints or key in self._floats:
+            if not value.strip():
+                return None
+            try:
+                return int(value) if key in self._ints else float(value)
+            except ValueError:
+                errors.append("Option %s in section [%s] should be a number, not '%s'" % (option, section, value))
+                return None
+        elif key in self._lists:
+            return tuple([t.strip() for t in value.split(',')])
+        elif key == 'outputdirectory':
+            return value + '/' if value and value[-1] != '/' else value
+        elif key in self._templates:
+            if '.' not in value:
+                errors.append('%s should have an extension' % option)
+            elif 'DATE' not in value.rsplit('.', 1)[0]:
+                errors.append('No DATE placeholder in %s' % option)
+        return value
+
+    def _brokers(self, options, errors):
+        """Enumerated BrokersServer options as (host, port) sorted by their
+           number."""
+        bn = [serv for serv in options.keys() if 'brokers' in serv]
+        if len(bn) > 1:
+            try:
+                bn = sorted(bn, key=lambda s: int(re.search("(server)([0-9]*)", s).group(2)))
+            except (ValueError, AttributeError):
+                errors.append("List of broker servers should be enumerated")
+                return ()
+
+        tupleserv = []
+        for brokopt in bn:
+            value = options.pop(brokopt)
+            if ':' not in value:
+                self._error("Port should be specified for %s" % value)
+                server, port = value, 6163
+            else:
+                (server, port) = value.split(':')
+            try:
+                tupleserv.append((server, int(port)))
+            except ValueError:
+                errors.append("Port of %s should be a number" % value)
+        return tuple(tupleserv)
+
+    def _validate(self, options, errors):
+        """Checks of values against choices of components and of options
+           depending on each other, so that components never refuse values
+           of a snapshot on load."""
+        from argo_egi_consumer.reader import ACKMODES
+        from argo_egi_consumer.msgqueue import QUEUEPOLICIES
+        from argo_egi_consumer.dedup import DEDUPPOLICIES
+        from argo_egi_consumer.workers import SHARDFIELDS
+        from argo_egi_consumer.writer import FSYNCPOLICIES, PTXTCOMPRESSIONS, zstandard
+        from avro.datafile import VALID_CODECS
+
+        for opt in REQUIREDOPTIONS:
+            if opt.lower() not in options:
+                errors.append('No option %s defined' % opt)
+        if not options.get('brokerserver'):
+            errors.append('No broker server defined')
+
+        choices = [('STOMPAckMode', ACKMODES), ('OutputFsyncPolicy', FSYNCPOLICIES),
+                   ('OutputCodec', VALID_CODECS), ('OutputPlaintextCompression', sorted(PTXTCOMPRESSIONS)),
+                   ('QueueFullPolicy', QUEUEPOLICIES), ('DedupPolicy', DEDUPPOLICIES),
+                   ('WorkersShardBy', sorted(SHARDFIELDS))]
+        for opt, allowed in choices:
+            value = options.get(opt.lower())
+            if value and value.lower() not in allowed:
+                errors.append('%s should be one of %s' % (opt, ', '.join(allowed)))
+
+        if (options.get('outputplaintextcompression') or '').lower() == 'zstd' and zstandard is None:
+            errors.append('OutputPlaintextCompression zstd needs zstandard module')
+        if (options.get('queuefullpolicy') or '').lower() == 'spill' and not options.get('queuespillfile'):
+            errors.append('QueueSpillFile should be defined for spill policy')
+        templates = [(opt, options[opt.lower()]) for opt in TEMPLATEOPTIONS if opt.lower() in options]
+        if options.get('outputmaxfilesize'):
+            for opt, template in templates:
+                if 'SEQ' not in template:
+                    errors.append('OutputMaxFileSize needs SEQ placeholder in %s' % opt)
+        if options.get('workersprocesses'):
+            for opt, template in templates:
+                if 'SHARD' not in template:
+                    errors.append('WorkersProcesses needs SHARD placeholder in %s' % opt)
+        schema = options.get('generalavroschema')
+        if schema and not os.path.isfile(schema):
+            errors.append('Could not find Avro schema %s' % schema)
 
     def parse(self):
+        """Read config file into new snapshot and swap it in place of the
+           current one. Invalid config is refused as a whole with every
+           error logged, on first parse the consumer exits. Returns whether
+           the snapshot was replaced."""
+        start = time.time()
         config = ConfigParser.ConfigParser()
+        errors = []
         if not os.path.exists(self._filename):
-            sh.Logger.error(repr(self.__class__) + ' Could not find %s ' % self._filename)
-            raise SystemExit(1)
-        config.read(self._filename)
+            errors.append('Could not find %s' % self._filename)
+        else:
+            try:
+                config.read(self._filename)
+            except ConfigParser.Error as e:
+                errors.append(str(e).strip())
 
-        try:
+        options = {}
+        if not errors:
             for sect, opts in self._args.items():
                 for opt in opts:
                     for section in config.sections():
                         if section.lower().startswith(sect.lower()):
                             for o in config.options(section):
                                 if o.startswith(opt.lower()):
-                                    optget = config.get(section, o)
-                                    self._options.update({(sect+o).lower(): optget})
-        except ConfigParser.NoOptionError as e:
-            sh.Logger.error(repr(self.__class__) + " No option '%s' in section: '%s' " % (e.args[0], e.args[1]))
-            raise SystemExit(1)
-        except ConfigParser.NoSectionError as e:
-            sh.Logger.error(repr(self.__class__) + "No section '%s' defined" % (e.args[0]))
-            raise SystemExit(1)
+                                    key = (sect+o).lower()
+                                    try:
+                                        value = config.get(section, o)
+                                    except ConfigParser.Error as e:
+                                        errors.append(str(e).strip())
+                                        continue
+                                    value = self._convert(section, o, key, value, errors)
+                                    if value is not None:
+                                        options[key] = value
+            options['brokerserver'] = self._brokers(options, errors)
+            self._validate(options, errors)
 
-    def get_option(self, opt, optional=False):
-        if not self._options:
+        if errors:
+            for e in errors:
+                self._error(e)
+            if not self._snapshot:
+                raise SystemExit(1)
+            sh.Logger.error('Config %s not reloaded, keeping the previous one' % self._filename)
+            return False
+
+        loadtime = time.time() - start
+        metrics.configloadtime.observe(loadtime)
+        self._snapshot = ConfSnapshot(self._filename, options, loadtime)
+        return True
+
+    def snapshot(self):
+        if not self._snapshot:
             self.parse()
-        try:
-            if opt.startswith('Broker'.lower()):
-                sortbrokers, tupleserv = [], []
-                bn = [serv for serv in self._options.keys() if 'brokers' in serv]
-                if len(bn) > 1:
-                    try:
-                        sortbrokers = sorted(bn, key=lambda s:
-                                            int(re.search("(server)([0-9]*)", s).group(2)))
-                    except ValueError, IndexError:
-                        sh.Logger.error(repr(self.__class__) + " List of broker servers should be enumerated")
-                        raise SystemExit(1)
-                else:
-                    sortbrokers = bn
-
-                for brokopt in sortbrokers:
-                    value = self._options[brokopt]
-                    if ':' not in value:
-                        sh.Logger.error(repr(self.__class__) + " Port should be specified for %s" % value)
-                        port = 6163
-                        server = value
-                    else:
-                        (server, port) = value.split(':')
-                    tupleserv.append((server, int(port)))
-
-                return tupleserv
-
-            elif opt.startswith('OutputDirectory'.lower()):
-                return self._options[opt] + '/' if self._options[opt][-1] != '/' else self._options[opt]
-
-            elif opt.startswith('OutputFilename'.lower()) or \
-                 opt.startswith('OutputErrorFilename'.lower()):
-                if '.' not in self._options[opt]:
-                    sh.Logger.error('%s should have an extension' % opt)
-                    raise SystemExit(1)
-                if not re.search(r'DATE(.\w+)$', self._options[opt]):
-                    sh.Logger.error('No DATE placeholder in %s' % opt)
-                    raise SystemExit(1)
-                else:
-                    return self._options[opt]
-
-            elif opt.startswith('GeneralLogMsgOutAllowedTime'.lower()) or \
-                 opt.startswith('GeneralLogWrongFormat'.lower()) or \
-                 opt.startswith('GeneralWritePlaintext'.lower()) or \
-                 opt.startswith('STOMPUseSSL'.lower()):
-                return eval(self._options[opt])
-
-            elif opt.startswith('SubscriptionIdleMsgTimeout'.lower()) or \
-                 opt.startswith('STOMPTCPKeepAliveIdle'.lower()) or \
-                 opt.startswith('STOMPTCPKeepAliveInterval'.lower()) or \
-                 opt.startswith('STOMPTCPKeepAliveProbes'.lower()) or \
-                 opt.startswith('MsgRetentionFutureDaysOK'.lower()) or \
-                 opt.startswith('MsgRetentionPastDaysOK'.lower()) or \
-                 opt.startswith('STOMPReconnectAttempts'.lower()) or \
-                 opt.startswith('SubscriptionIdleMsgTimeout'.lower()):
-                return int(self._options[opt])
-
-            elif opt.startswith('SubscriptionDestinations'.lower()):
-                return [t.strip() for t in self._options[opt].split(',')]
+        return self._snapshot
 
-            else:
-                return self._options[opt]
+    def swap(self, snapshot):
+        """Use snapshot built by parse in another process."""
+        self._snapshot = snapshot
 
+    def get_option(self, opt, optional=False):
+        snapshot = self._snapshot or self.snapshot()
+        if opt.startswith('Broker'.lower()):
+            opt = 'brokerserver'
+        try:
+            value = snapshot[opt]
         except KeyError as e:
             if not optional:
                 sh.Logger.error(repr(self.__class__) + " No option %s defined" % e)
                 raise SystemExit(1)
             else:
                 return None
+        return list(value) if isinstance(value, tuple) else value
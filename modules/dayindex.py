@@ -0,0 +1,173 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import json
+import os
+from avro.datafile import DataFileReader
+from avro.io import DatumReader
+
+INDEXEXT = '.idx'
+PARTEXT = '.idx.part'
+
+def summarize(records):
+    """Keys (hostname, metric, service) and min and max timestamp of Avro
+       records about to be appended to the same block."""
+    keys, tmin, tmax = set(), None, None
+    for rec in records:
+        keys.add((rec.get('hostname'), rec.get('metric'), rec.get('service')))
+        ts = rec.get('timestamp')
+        if tmin is None or ts < tmin:
+            tmin = ts
+        if tmax is None or ts > tmax:
+            tmax = ts
+    return keys, tmin, tmax
+
+class DayFileIndex:
+    """Sidecar index of Avro day file mapping (hostname, metric, service)
+       to offsets of blocks holding their records, with min and max
+       timestamp per block. Blocks are appended to .idx.part file as they
+       are flushed. Compact .idx file is written on finalize when day file
+       is closed, to temporary name renamed into place, and .idx.part is
+       removed. Sidecars left from earlier day file of the same name are
+       removed if fresh is set."""
+    def __init__(self, avrofile, fresh=False):
+        self.avroFile = avrofile
+        self.blocks = []
+        self.keys = {}
+        self._part = None
+        self._pendkeys, self._pendmin, self._pendmax, self._pendcount = set(), None, None, 0
+        if fresh:
+            for ext in (INDEXEXT, PARTEXT):
+                if os.path.exists(avrofile + ext):
+                    os.remove(avrofile + ext)
+        else:
+            self._load()
+
+    def _addblock(self, offset, count, tmin, tmax, keys):
+        if self.blocks and offset <= self.blocks[-1][0]:
+            return
+        num = len(self.blocks)
+        self.blocks.append([offset, count, tmin, tmax])
+        for key in keys:
+            self.keys.setdefault(tuple(key), []).append(num)
+
+    def _load(self):
+        if os.path.exists(self.avroFile + INDEXEXT):
+            index = json.load(open(self.avroFile + INDEXEXT))
+            self.blocks = index['blocks']
+            for hostname, metric, service, blocks in index['keys']:
+                self.keys[(hostname, metric, service)] = blocks
+        if os.path.exists(self.avroFile + PARTEXT):
+            for line in open(self.avroFile + PARTEXT):
+                try:
+                    offset, count, tmin, tmax, keys = json.loads(line)
+                except ValueError:
+                    # line torn by crash
+                    break
+                self._addblock(offset, count, tmin, tmax, keys)
+
+    def add(self, keys, tmin, tmax, count):
+        """Records summarized with summarize() appended to current block."""
+        self._pendkeys.update(keys)
+        if self._pendmin is None or tmin < self._pendmin:
+            self._pendmin = tmin
+        if self._pendmax is None or tmax > self._pendmax:
+            self._pendmax = tmax
+        self._pendcount += count
+
+    def block(self, offset):
+        """Current block was written at offset of day file."""
+        if not self._pendcount:
+            return
+        keys = sorted(self._pendkeys)
+        self._addblock(offset, self._pendcount, self._pendmin, self._pendmax, keys)
+        if not self._part:
+            self._part = open(self.avroFile + PARTEXT, 'a')
+        self._part.write(json.dumps([offset, self._pendcount, self._pendmin, self._pendmax, keys]) + '\n')
+        self._pendkeys, self._pendmin, self._pendmax, self._pendcount = set(), None, None, 0
+
+    def flush(self):
+        if self._part:
+            self._part.flush()
+
+    def finalize(self):
+        if self._part:
+            self._part.close()
+            self._part = None
+        tmpname = self.avroFile + INDEXEXT + '.tmp'
+        index = open(tmpname, 'w')
+        json.dump({'blocks': self.blocks,
+                   'keys': [list(key) + [blocks] for key, blocks in sorted(self.keys.items())]}, index)
+        index.flush()
+        os.fsync(index.fileno())
+        index.close()
+        os.rename(tmpname, self.avroFile + INDEXEXT)
+        if os.path.exists(self.avroFile + PARTEXT):
+            os.remove(self.avroFile + PARTEXT)
+
+    def lookup(self, hostname=None, metric=None, service=None, since=None, until=None):
+        """Offsets of blocks that may hold records matching all given
+           fields and with timestamps overlapping [since, until]."""
+        if hostname is None and metric is None and service is None:
+            nums = range(len(self.blocks))
+        else:
+            nums = set()
+            for (h, m, s), blocks in self.keys.items():
+                if (hostname is None or h == hostname) and \
+                        (metric is None or m == metric) and \
+                        (service is None or s == service):
+                    nums.update(blocks)
+        offsets = []
+        for num in sorted(nums):
+            offset, count, tmin, tmax = self.blocks[num]
+            if (since is None or tmax >= since) and (until is None or tmin <= until):
+                offsets.append(offset)
+        return offsets
+
+def read(avrofile, hostname=None, metric=None, service=None, since=None, until=None):
+    """Records of day file matching given fields and timestamp range,
+       decoding only the blocks pointed to by sidecar index."""
+    index = DayFileIndex(avrofile)
+    offsets = index.lookup(hostname, metric, service, since, until)
+    reader = DataFileReader(open(avrofile, 'rb'), DatumReader())
+    try:
+        for offset in offsets:
+            if offset >= reader.file_length:
+                continue
+            reader.reader.seek(offset)
+            reader.block_count = 0
+            rec = reader.next()
+            while True:
+                if (hostname is None or rec['hostname'] == hostname) and \
+                        (metric is None or rec['metric'] == metric) and \
+                        (service is None or rec['service'] == service) and \
+                        (since is None or rec['timestamp'] >= since) and \
+                        (until is None or rec['timestamp'] <= until):
+                    yield rec
+                if not reader.block_count:
+                    break
+                rec = reader.next()
+    finally:
+        reader.close()
@@ -0,0 +1,153 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from argo_egi_consumer.shared import SingletonShared as Shared
+
+defaultDedupPolicy = 'lru'
+defaultDedupSize = 100000
+defaultDedupWindow = 3600
+defaultBloomCapacity = 1000000
+defaultBloomErrorRate = 0.000001
+DEDUPPOLICIES = ['lru', 'window', 'off']
+
+sh = Shared()
+
+class BloomFilter:
+    """Bit array sized for capacity items at false positive rate, bit
+       positions derived from MD5 of the key by double hashing."""
+    def __init__(self, capacity, errorrate):
+        self.nbits = max(int(-capacity * math.log(errorrate) / math.log(2)**2), 8)
+        self.nhashes = max(int(round(self.nbits * math.log(2) / capacity)), 1)
+        self.bits = bytearray((self.nbits + 7) / 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.md5(key).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        return [(h1 + i*h2) % self.nbits for i in xrange(self.nhashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class MessageDedup:
+    """Bounded set of seen message-ids. With lru policy the Size most
+       recently seen ids are kept, with window policy ids seen in the last
+       Window seconds, but no more than Size of them. Ids evicted from the
+       set can be kept in two generations of Bloom filters of
+       BloomCapacity ids each, so duplicates are recognized much longer
+       with few bytes per id at the cost of dropping unique message at
+       BloomErrorRate."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._bloom, self._bloomprev = None, None
+        self.policy, self.bloomParams = None, None
+        self.nchecked, self.nduplicates, self.nbloomhits, self.nevicted = 0, 0, 0, 0
+        self.load()
+
+    def load(self):
+        policy = sh.ConsumerConf.get_option('DedupPolicy'.lower(), optional=True)
+        size = sh.ConsumerConf.get_option('DedupSize'.lower(), optional=True)
+        window = sh.ConsumerConf.get_option('DedupWindow'.lower(), optional=True)
+        bloom = sh.ConsumerConf.get_option('DedupBloomFilter'.lower(), optional=True)
+        capacity = sh.ConsumerConf.get_option('DedupBloomCapacity'.lower(), optional=True)
+        errorrate = sh.ConsumerConf.get_option('DedupBloomErrorRate'.lower(), optional=True)
+        policy = policy.lower() if policy else defaultDedupPolicy
+        bloomparams = (capacity if capacity else defaultBloomCapacity,
+                       errorrate if errorrate else defaultBloomErrorRate) if bloom else None
+
+        self._lock.acquire()
+        try:
+            if policy != self.policy:
+                self._seen = OrderedDict()
+            if bloomparams != self.bloomParams:
+                self._bloom = BloomFilter(*bloomparams) if bloomparams else None
+                self._bloomprev = None
+            self.policy, self.bloomParams = policy, bloomparams
+            self.size = size if size else defaultDedupSize
+            self.window = window if window else defaultDedupWindow
+            self._evict(time.time())
+        finally:
+            self._lock.release()
+
+    def _evict(self, now):
+        while len(self._seen) > self.size or \
+                self._seen and self.policy == 'window' and \
+                now - self._seen[next(iter(self._seen))] > self.window:
+            msgid, tseen = self._seen.popitem(last=False)
+            self.nevicted += 1
+            if self._bloom is not None:
+                if self._bloom.count >= self.bloomParams[0]:
+                    self._bloomprev, self._bloom = self._bloom, BloomFilter(*self.bloomParams)
+                self._bloom.add(msgid)
+
+    def seen(self, msgid):
+        """True if msgid was seen before, otherwise it is remembered."""
+        if self.policy == 'off' or msgid is None:
+            return False
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self.nchecked += 1
+            if msgid in self._seen:
+                self.nduplicates += 1
+                if self.policy == 'lru':
+                    self._seen[msgid] = self._seen.pop(msgid)
+                return True
+            if self._bloom is not None and (msgid in self._bloom or
+                                            self._bloomprev is not None and msgid in self._bloomprev):
+                self.nduplicates += 1
+                self.nbloomhits += 1
+                return True
+            self._seen[msgid] = now
+            self._evict(now)
+            return False
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            bloom = ''
+            if self._bloom is not None:
+                nbytes = len(self._bloom.bits) + (len(self._bloomprev.bits) if self._bloomprev else 0)
+                bloom = ', %i found in Bloom filter of %i KB' % (self.nbloomhits, nbytes / 1024)
+            return 'Dropped %i duplicated messages of %i checked, %s policy, %i ids remembered, %i evicted%s' % \
+                (self.nduplicates, self.nchecked, self.policy, len(self._seen), self.nevicted, bloom)
+        finally:
+            self._lock.release()
@@ -0,0 +1,223 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import BaseHTTPServer
+import SocketServer
+import bisect
+import os
+import threading
+
+DEFAULTBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENTTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _labelstr(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+def _num(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Named series with optional labels, every update holds the metric
+       lock so it can be changed from any thread."""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        registry.append(self)
+
+    def remove(self, labels):
+        self._lock.acquire()
+        self._values.pop(tuple(labels), None)
+        self._lock.release()
+
+    def _samples(self):
+        self._lock.acquire()
+        try:
+            return [(labels, value) for labels, value in self._values.items()]
+        finally:
+            self._lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, value in sorted(self._samples()):
+            lines.append('%s%s %s' % (self.name, _labelstr(self.labelnames, labels), _num(value)))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, labels=()):
+        self._lock.acquire()
+        self._values[labels] = self._values.get(labels, 0) + n
+        self._lock.release()
+
+    def value(self, labels=()):
+        self._lock.acquire()
+        try:
+            return self._values.get(labels, 0)
+        finally:
+            self._lock.release()
+
+class Gauge(Metric):
+    """Gauge whose value is either set or read from function at the time
+       metrics are rendered."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self._func = None
+
+    def set(self, value, labels=()):
+        self._lock.acquire()
+        self._values[labels] = value
+        self._lock.release()
+
+    def setfunc(self, func):
+        self._func = func
+
+    def _samples(self):
+        func = self._func
+        if func:
+            return [((), func())]
+        return Metric._samples(self)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULTBUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        self._lock.acquire()
+        try:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+        finally:
+            self._lock.release()
+
+    def _samples(self):
+        self._lock.acquire()
+        try:
+            return [(labels, (list(counts), total, n)) for labels, (counts, total, n) in self._values.items()]
+        finally:
+            self._lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for labels, (counts, total, n) in sorted(self._samples()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labelstr(self.labelnames, labels,
+                                                                     'le="%s"' % _num(bound)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _labelstr(self.labelnames, labels), repr(total)))
+            lines.append('%s_count%s %d' % (self.name, _labelstr(self.labelnames, labels), n))
+        return lines
+
+registry = []
+
+received = Counter('argo_consumer_messages_received_total', 'Messages received from brokers', ['slot'])
+duplicates = Counter('argo_consumer_messages_duplicated_total', 'Messages dropped as duplicates')
+parsetime = Histogram('argo_consumer_parse_seconds', 'Time to parse message')
+rejected = Counter('argo_consumer_messages_rejected_total', 'Messages failing validation', ['reason'])
+written = Counter('argo_consumer_messages_written_total', 'Messages passed to writer')
+writetime = Histogram('argo_consumer_write_seconds', 'Time to append batch of records to day file', ['file'])
+flushtime = Histogram('argo_consumer_flush_seconds', 'Time to flush block to day file')
+writtenbytes = Counter('argo_consumer_written_bytes_total', 'Bytes written to output files', ['format'])
+queuedepth = Gauge('argo_consumer_queue_depth', 'Messages waiting in queue for writer')
+reconnects = Counter('argo_consumer_reconnects_total', 'Connections to brokers after the first one', ['slot'])
+disconnected = Counter('argo_consumer_disconnected_seconds_total', 'Time spent without broker connection', ['slot'])
+brokerhealth = Gauge('argo_consumer_broker_health', 'Moving average of outcomes of connections to broker', ['broker'])
+configloadtime = Histogram('argo_consumer_config_load_seconds', 'Time to read and validate config file')
+reloadpause = Histogram('argo_consumer_reload_pause_seconds', 'Time writers were paused by config reload')
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENTTYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TCPMetricsServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixMetricsServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer:
+    """Serve metrics in Prometheus text format over HTTP on host:port or on
+       Unix socket given as unix:/path."""
+    def __init__(self, listen):
+        self.listen = listen
+        self.path = None
+        if listen.startswith('unix:'):
+            self.path = listen[len('unix:'):]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = UnixMetricsServer(self.path, MetricsHandler)
+        else:
+            host, port = listen.rsplit(':', 1)
+            self.server = TCPMetricsServer((host, int(port)), MetricsHandler)
+        self.th = threading.Thread(target=self.server.serve_forever, name='metrics_thread')
+        self.th.daemon = True
+        self.th.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
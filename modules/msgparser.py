@@ -0,0 +1,131 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+MANDATORY = ('serviceType', 'timestamp', 'hostName', 'metricName', 'metricStatus')
+OPTIONAL = ('detailsData', 'summaryData', 'nagios_host', 'ROC', 'voName', 'voFqan')
+WANTED = frozenset(MANDATORY + OPTIONAL + ('message-id',))
+SLOTNAMES = dict([(key, key) for key in MANDATORY + OPTIONAL] + [('message-id', 'msgid')])
+
+class MetricResult(object):
+    """Fields of metric result consumed by the writer. fields holds the
+       full header and body dict only when result is built from one."""
+    __slots__ = MANDATORY + OPTIONAL + ('msgid', 'fields', '_tags')
+
+    def __init__(self):
+        self.serviceType = self.timestamp = self.hostName = None
+        self.metricName = self.metricStatus = None
+        self.detailsData = self.summaryData = self.nagios_host = None
+        self.ROC = self.voName = self.voFqan = None
+        self.msgid = self.fields = self._tags = None
+
+    @classmethod
+    def fromfields(cls, fields):
+        result = cls()
+        for key in WANTED:
+            if key in fields:
+                setattr(result, SLOTNAMES[key], fields[key])
+        result.fields = fields
+        return result
+
+    def missing(self):
+        return [key for key in MANDATORY if getattr(self, key) is None]
+
+    def tags(self):
+        if self._tags is None:
+            self._tags = {'roc': self.ROC, 'voName': self.voName, 'voFqan': self.voFqan}
+        return self._tags
+
+    def services(self):
+        """One view per service type, paired service types like
+           'SRM,SRMv2' give two."""
+        if ',' in self.serviceType:
+            servtype = self.serviceType.split(',')
+            return [ServiceView(self, servtype[0].strip()),
+                    ServiceView(self, servtype[1].strip())]
+        else:
+            return [ServiceView(self, self.serviceType)]
+
+class ServiceView(object):
+    """Avro record datum of metric result for one of its service types,
+       fields are looked up by Avro field name on the result."""
+    __slots__ = ('result', 'service')
+
+    def __init__(self, result, service):
+        self.result = result
+        self.service = service
+
+    def get(self, name, default=None):
+        if name == 'service':
+            return self.service
+        elif name == 'tags':
+            return self.result.tags()
+        attr = AVROFIELDS.get(name)
+        return getattr(self.result, attr) if attr else default
+
+AVROFIELDS = {'timestamp': 'timestamp', 'hostname': 'hostName',
+              'metric': 'metricName', 'status': 'metricStatus',
+              'monitoring_host': 'nagios_host', 'summary': 'summaryData',
+              'message': 'detailsData'}
+
+def parse(headers, body):
+    """Single pass over message body decoded once, keeping only the fields
+       consumed by the writer. Header values are overridden with body ones
+       just like in full parse."""
+    result = MetricResult()
+    for key in headers:
+        attr = SLOTNAMES.get(key)
+        if attr:
+            setattr(result, attr, headers[key])
+    for line in body.decode('utf-8', 'replace').split(u'\n'):
+        key, sep, value = line.partition(u': ')
+        if sep:
+            attr = SLOTNAMES.get(key)
+            if attr:
+                setattr(result, attr, value)
+    return result
+
+def field(headers, body, key):
+    """Value of one field as parse would set it, last line of body with
+       the key or header, without decoding the whole body."""
+    marker = key + ': '
+    start = body.rfind('\n' + marker)
+    if start >= 0:
+        start += len(marker) + 1
+    elif body.startswith(marker):
+        start = len(marker)
+    else:
+        return headers.get(key)
+    end = body.find('\n', start)
+    return body[start:end] if end >= 0 else body[start:]
+
+def parsefull(headers, body):
+    """All header and body fields, needed for plaintext and WRONGFORMAT
+       output."""
+    fields = dict(headers)
+    for line in body.decode('utf-8', 'replace').split(u'\n'):
+        key, sep, value = line.partition(u': ')
+        if sep:
+            fields[key.encode('utf-8')] = value
+    return fields
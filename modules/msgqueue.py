@@ -0,0 +1,192 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import cPickle
+import os
+import threading
+import time
+from collections import deque
+from argo_egi_consumer.shared import SingletonShared as Shared
+
+defaultQueueCapacity = 10000
+defaultQueueFullPolicy = 'block'
+QUEUEPOLICIES = ['block', 'dropoldest', 'spill']
+
+sh = Shared()
+
+class MessageQueue:
+    """Bounded queue between STOMP receiver thread and writer stage. When
+       queue is full, producer either blocks, oldest message is dropped or
+       message is spilled to file and picked up again once queue drains.
+       Items are (headers, message, token), only headers and message go to
+       spill file while token stays in memory under its offset in the file,
+       as acker and spool keep references to it. Messages spilled before
+       restart come back without token."""
+    def __init__(self):
+        self._queue = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._spill = None
+        self._spillread = 0
+        self._spilltokens = {}
+        self.ondrop = None
+        self.nput, self.nget, self.ndropped, self.nspilled = 0, 0, 0, 0
+        self.nwaited = 0
+        self.waitsum, self.waitmax, self.blocksum = 0.0, 0.0, 0.0
+        self.load()
+
+    def load(self):
+        capacity = sh.ConsumerConf.get_option('QueueCapacity'.lower(), optional=True)
+        policy = sh.ConsumerConf.get_option('QueueFullPolicy'.lower(), optional=True)
+        self.spillFile = sh.ConsumerConf.get_option('QueueSpillFile'.lower(), optional=True)
+        self.capacity = capacity if capacity else defaultQueueCapacity
+        self.policy = policy.lower() if policy else defaultQueueFullPolicy
+        self._cond.acquire()
+        try:
+            # messages spilled before restart are picked up again
+            if self.spillFile and not self._spill and os.path.exists(self.spillFile):
+                try:
+                    self._spill = open(self.spillFile, 'a+b')
+                    self._spillread = 0
+                except (IOError, OSError) as e:
+                    sh.Logger.error(e)
+                    raise SystemExit(1)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _spillput(self, item):
+        try:
+            if not self._spill:
+                self._spill = open(self.spillFile, 'a+b')
+                self._spillread = 0
+            self._spill.seek(0, 2)
+            headers, message, token = item
+            if token is not None:
+                self._spilltokens[self._spill.tell()] = token
+            cPickle.dump((headers, message), self._spill, 2)
+            self._spill.flush()
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+        self.nspilled += 1
+
+    def _spillget(self, maxitems):
+        items = []
+        try:
+            self._spill.seek(self._spillread)
+            while len(items) < maxitems:
+                offset = self._spill.tell()
+                try:
+                    headers, message = cPickle.load(self._spill)
+                except EOFError:
+                    break
+                items.append((headers, message, self._spilltokens.pop(offset, None)))
+            self._spillread = self._spill.tell()
+            self._spill.seek(0, 2)
+            if self._spillread == self._spill.tell():
+                self._spill.close()
+                os.remove(self.spillFile)
+                self._spill = None
+        except (IOError, OSError, cPickle.UnpicklingError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+        return items
+
+    def put(self, item):
+        self._cond.acquire()
+        try:
+            if len(self._queue) >= self.capacity:
+                if self.policy == 'dropoldest':
+                    tput, dropped = self._queue.popleft()
+                    self.ndropped += 1
+                    if self.ondrop:
+                        self.ondrop(dropped)
+                elif self.policy == 'spill':
+                    self._spillput(item)
+                    self._cond.notify()
+                    return
+                else:
+                    start = time.time()
+                    while len(self._queue) >= self.capacity and not self._closed:
+                        self._cond.wait(1.0)
+                    self.blocksum += time.time() - start
+            self._queue.append((time.time(), item))
+            self.nput += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def get(self, maxitems, timeout):
+        """Return up to maxitems queued messages, waiting at most timeout
+           seconds for the first one. Spilled messages are returned when
+           in-memory queue is empty."""
+        self._cond.acquire()
+        try:
+            if not self._queue and not self._spill and not self._closed:
+                self._cond.wait(timeout)
+            items = []
+            now = time.time()
+            while self._queue and len(items) < maxitems:
+                tput, item = self._queue.popleft()
+                wait = now - tput
+                self.waitsum += wait
+                self.nwaited += 1
+                if wait > self.waitmax:
+                    self.waitmax = wait
+                items.append(item)
+            if not items and self._spill:
+                items = self._spillget(maxitems)
+            self.nget += len(items)
+            self._cond.notifyAll()
+            return items
+        finally:
+            self._cond.release()
+
+    def close(self):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def isclosed(self):
+        return self._closed
+
+    def depth(self):
+        return len(self._queue)
+
+    def empty(self):
+        return not self._queue and not self._spill
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return 'Queue depth %i/%i, dropped %i, spilled %i, avg wait %.3f s, max wait %.3f s, blocked %.2f s' % \
+                (len(self._queue), self.capacity, self.ndropped, self.nspilled,
+                 self.waitsum/self.nwaited if self.nwaited else 0.0, self.waitmax, self.blocksum)
+        finally:
+            self._cond.release()
@@ -23,10 +23,16 @@
 # the EGI-InSPIRE project through the European Commission's 7th
 # Framework Programme (contract # INFSO-RI-261323)
 
+import ctypes
+import ctypes.util
 import datetime
 import decimal
+import errno
+import fcntl
 import logging
 import os
+import random
+import select
 import stomp
 import socket
 import signal
@@ -36,176 +42,836 @@ import traceback
 import threading
 from collections import deque
 from argo_egi_consumer.writer import MessageWriter
+from argo_egi_consumer.msgqueue import MessageQueue
+from argo_egi_consumer.spool import MessageSpool
+from argo_egi_consumer.dedup import MessageDedup
+from argo_egi_consumer.metrics import MetricsServer
+from argo_egi_consumer.workers import WorkerPool
+from argo_egi_consumer import metrics
 from argo_egi_consumer.shared import SingletonShared as Shared
+from argo_egi_consumer.shared import shutdown
+
+msgBatchSize = 500
+ACKMODES = ['auto', 'client', 'client-individual']
+writerJoinTimeout = 30
+connectTimeout = 10
+defaultReconnectDelay = 1000
+defaultReconnectMaxDelay = 60000
+stableConnection = 60
+healthWeight = 0.3
+CLOCK_MONOTONIC = 1
 
 sh = Shared()
 
-class DestListener(stomp.ConnectionListener):
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'),
+                                 use_errno=True).clock_gettime
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+def monotonic():
+    """Seconds from CLOCK_MONOTONIC, not affected by changes of wall
+       clock, time.time() where it is not available."""
+    if _clock_gettime is None:
+        return time.time()
+    ts = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+class Waker:
+    """Self-pipe that wakes thread waiting on it. Waiting is select() with
+       timeout, so there are no periodic wakeups and signal handlers of
+       main thread still run while it waits."""
     def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+    def set(self):
+        try:
+            os.write(self._wfd, '.')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        """Wait for set() or timeout seconds, None waits without limit."""
+        try:
+            ready = select.select([self._rfd], [], [], max(timeout, 0) if timeout is not None else None)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if ready:
+            try:
+                while os.read(self._rfd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        return bool(ready)
+
+class MessageAcker:
+    """In client and client-individual ack mode messages are acknowledged
+       only after writer flushed the blocks holding them. In client mode one
+       cumulative ACK is sent per subscription for the longest run of
+       flushed messages in receive order."""
+    def __init__(self, slot):
+        self.slot = slot
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._gen = 0
+        self.conn = None
+        self.nacks = 0
+        self.load()
+
+    def load(self):
+        mode = sh.ConsumerConf.get_option('STOMPAckMode'.lower(), optional=True)
+        self.mode = mode.lower() if mode else 'auto'
+
+    def setconn(self, conn):
+        self._lock.acquire()
+        try:
+            self.conn = conn
+            self._gen = time.time()
+            self._pending = {}
+        finally:
+            self._lock.release()
+
+    def received(self, headers):
+        if self.mode == 'auto':
+            return None
+        token = {'slot': self.slot, 'gen': self._gen, 'id': headers['message-id'],
+                 'sub': headers.get('subscription'), 'done': False}
+        if self.mode == 'client':
+            self._lock.acquire()
+            try:
+                key = token['sub'] or headers.get('destination')
+                self._pending.setdefault(key, deque()).append(token)
+            finally:
+                self._lock.release()
+        return token
+
+    def durable(self, tokens):
+        acks = []
+        self._lock.acquire()
+        try:
+            for token in tokens:
+                if token:
+                    token['done'] = True
+                    if self.mode == 'client-individual' and token['gen'] == self._gen:
+                        acks.append(token)
+            if self.mode == 'client':
+                for pend in self._pending.values():
+                    last = None
+                    while pend and pend[0]['done']:
+                        last = pend.popleft()
+                    if last:
+                        acks.append(last)
+            conn = self.conn
+        finally:
+            self._lock.release()
+
+        for token in acks:
+            ackheaders = {'message-id': token['id']}
+            if token['sub']:
+                ackheaders['subscription'] = token['sub']
+            try:
+                conn.ack(ackheaders)
+                self.nacks += 1
+            except (socket.error, stomp.exception.NotConnectedException) as e:
+                sh.Logger.warning('Could not acknowledge message %s: %s' % (token['id'], e))
+                break
+
+class DestListener(stomp.ConnectionListener):
+    def __init__(self, pipeline, slot):
+        self.pipeline = pipeline
         self.connected = False
-        self.connectedCounter = 100
-        self.writer = MessageWriter()
+        self.connecting = False
+        self.lastrecv = monotonic()
+        self.onchange = None
+        self.acker = MessageAcker(slot)
+        self._slotlabels = (str(slot),)
 
     def load(self):
-        pass
+        self.acker.load()
+
+    def _changed(self):
+        if self.onchange:
+            self.onchange()
 
     def on_connected(self, headers, body):
         sh.Logger.info('Listener connected, session %s' % headers['session'])
-        self.connected = True
-        self.connectedCounter = 100
+        self.lastrecv = monotonic()
+        self.connected, self.connecting = True, False
+        self._changed()
 
     def on_disconnected(self):
         sh.Logger.warning("Listener disconnected")
-        self.connected = False
+        self.connected, self.connecting = False, False
+        self._changed()
+
+    def on_heartbeat_timeout(self):
+        sh.Logger.warning("Listener missed heart-beats from broker")
+        self.connected, self.connecting = False, False
+        self._changed()
 
     def on_error(self, headers, message):
         sh.Logger.error("Received error %s" % message)
+        self._changed()
 
     def on_message(self, headers, message):
-        lines = message.split('\n')
-        fields = dict()
-
-        #header fields
-        fields.update(headers)
-        # body fields
-        for line in lines:
-            splitLine = line.split(': ', 1)
-            if len(splitLine) > 1:
-                key = splitLine[0]
-                value = splitLine[1]
-                fields[key] = value.decode('utf-8', 'replace')
-
-        self.writer.writeMessage(fields)
-        sh.nummsg += 1
+        self.lastrecv = monotonic()
+        metrics.received.inc(labels=self._slotlabels)
+        if self.pipeline.closing and self.acker.mode != 'auto':
+            # not acknowledged, broker delivers it again after restart
+            return
+        try:
+            self.pipeline.put(headers, message, self.acker.received(headers))
+        except SystemExit:
+            shutdown()
 
-class MessageReader:
+class MessagePipeline:
+    """Writer stage shared by listeners of all broker connections. Messages
+       already seen with the same message-id are dropped before they are
+       queued for writing. With spool configured, frames are logged to it
+       before they are queued and replayed on startup if they did not make
+       it to the day files. With encoder workers, frames are parsed and
+       written by worker processes instead of writer threads. Reload
+       pauses writer threads between batches, so writer settings change
+       at a batch boundary."""
     def __init__(self):
-        self.listener = DestListener()
-        self._listconns = []
-        self._ths = []
-        self._wastupleserv = None
-        self._reconnconfreload = False
-        self.load()
+        # fork workers before any other thread is started
+        nworkers = sh.ConsumerConf.get_option('WorkersProcesses'.lower(), optional=True)
+        self.writer = WorkerPool(nworkers) if nworkers else MessageWriter()
+        spoolfile = sh.ConsumerConf.get_option('SpoolFile'.lower(), optional=True)
+        self.spool = MessageSpool(spoolfile) if spoolfile else None
+        self.writer.setDurableCallback(self.durable)
+        self.queue = MessageQueue()
+        self.queue.ondrop = lambda item: self.durable([item[2]])
+        self.closing = False
+        metrics.queuedepth.setfunc(self.queue.depth)
+        self.ackers = {}
+        self.dedup = MessageDedup()
+        # message-id of queued message and tokens of its duplicates that
+        # are passed to durable only once the first copy is written
+        self._inflight = {}
+        self._inflightlock = threading.Lock()
+        self._gate = threading.Condition(threading.Lock())
+        self._writing, self._paused = 0, False
+        nthreads = sh.ConsumerConf.get_option('QueueWriterThreads'.lower(), optional=True)
+        self.ths = []
+        for i in range(max(nthreads or 1, 1)):
+            th = threading.Thread(target=self._writemsgs, name='msgwriter_thread-%d' % i)
+            th.start()
+            self.ths.append(th)
+        if self.spool:
+            self.spool.replay(self._replayput)
 
     def load(self):
-        sh.ConsumerConf.parse()
+        self.queue.load()
+        self.writer.load()
+        self.dedup.load()
+        if self.spool:
+            self.spool.load()
 
-        tupleserv = sh.ConsumerConf.get_option('BrokerServer'.lower())
-        if self._wastupleserv and tupleserv != self._wastupleserv:
-            self._reconnconfreload = True
+    def reload(self):
+        """Load with writer threads paused, return seconds they were
+           paused."""
+        start = monotonic()
+        self._gate.acquire()
+        try:
+            self._paused = True
+            while self._writing:
+                self._gate.wait()
+        finally:
+            self._gate.release()
+        try:
+            self.load()
+        finally:
+            self._gate.acquire()
+            self._paused = False
+            self._gate.notifyAll()
+            self._gate.release()
+        return monotonic() - start
+
+    def _enter(self):
+        self._gate.acquire()
+        try:
+            while self._paused:
+                self._gate.wait()
+            self._writing += 1
+        finally:
+            self._gate.release()
+
+    def _leave(self):
+        self._gate.acquire()
+        self._writing -= 1
+        if not self._writing:
+            self._gate.notifyAll()
+        self._gate.release()
+
+    def put(self, headers, message, token):
+        msgid = headers.get('message-id')
+        if self.dedup.seen(msgid):
+            metrics.duplicates.inc()
+            self._duplicate(msgid, token)
         else:
-            self._reconnconfreload = False
-        self._wastupleserv = tupleserv
+            if self.spool:
+                token = self.spool.append(headers, message, token)
+            self._track(msgid, token)
+            self.queue.put((headers, message, token))
+
+    def _replayput(self, headers, message, token):
+        msgid = headers.get('message-id')
+        if self.dedup.seen(msgid):
+            self._duplicate(msgid, token)
+        else:
+            self._track(msgid, token)
+            self.queue.put((headers, message, token))
+
+    def _track(self, msgid, token):
+        if token is not None and msgid is not None:
+            token['dedupid'] = msgid
+            self._inflightlock.acquire()
+            self._inflight[msgid] = []
+            self._inflightlock.release()
+
+    def _duplicate(self, msgid, token):
+        """Duplicate is acknowledged only once its first copy is durable,
+           a redelivered message must not be acknowledged while the first
+           copy is still waiting in queue."""
+        self._inflightlock.acquire()
+        try:
+            held = self._inflight.get(msgid)
+            if held is not None:
+                held.append(token)
+                return
+        finally:
+            self._inflightlock.release()
+        self.durable([token])
+
+    def durable(self, tokens):
+        held = []
+        if self._inflight:
+            self._inflightlock.acquire()
+            for token in tokens:
+                if token and 'dedupid' in token:
+                    held.extend(self._inflight.pop(token['dedupid'], []))
+            self._inflightlock.release()
+        self._durable(tokens)
+        if held:
+            self._durable(held)
+
+    def _durable(self, tokens):
+        if self.spool:
+            self.spool.durable(tokens)
+        byslot = {}
+        for token in tokens:
+            if token:
+                byslot.setdefault(token['slot'], []).append(token)
+        for slot, slottokens in byslot.items():
+            if slot in self.ackers:
+                self.ackers[slot].durable(slottokens)
+
+    def _writemsgs(self):
+        try:
+            self._writeloop()
+        except SystemExit:
+            shutdown()
+
+    def _writeloop(self):
+        while not (sh.eventterm.isSet() or self.queue.isclosed()) or \
+                not self.queue.empty():
+            batch = self.queue.get(msgBatchSize, 1.0)
+            if batch:
+                frames = [(headers, message) for headers, message, token in batch]
+                tokens = [token for headers, message, token in batch]
+                self._enter()
+                try:
+                    self.writer.writeFrames(frames, tokens)
+                finally:
+                    self._leave()
+                metrics.written.inc(len(batch))
+
+    def close(self):
+        self.queue.close()
+        deadline = time.time() + writerJoinTimeout
+        for th in self.ths:
+            if th.isAlive():
+                th.join(max(deadline - time.time(), 0))
+        self.writer.close()
+        if self.spool:
+            self.spool.close()
+
+class BrokerHealth:
+    """Reliability of one broker shared by all connections. Score is moving
+       average of outcomes of connections to it, 1 for one that got
+       established and 0 for one that failed or dropped. After consecutive
+       failures broker is not tried again before jittered, exponentially
+       growing delay passes."""
+    def __init__(self, server):
+        self.server = server
+        self.score = 1.0
+        self.failures = 0
+        self.retryAt = 0
+        self.nconnects, self.nfailures = 0, 0
+        self._labels = ('%s:%i' % server,)
+        metrics.brokerhealth.set(self.score, self._labels)
+
+    def succeeded(self):
+        self.score = (1 - healthWeight) * self.score + healthWeight
+        self.nconnects += 1
+        metrics.brokerhealth.set(self.score, self._labels)
+
+    def failed(self, now, stable, delay, maxdelay):
+        """Connection failed or dropped, stable one resets backoff and is
+           retried right away."""
+        if stable:
+            self.failures = 0
+        self.score = (1 - healthWeight) * self.score
+        self.nfailures += 1
+        metrics.brokerhealth.set(self.score, self._labels)
+        if self.failures:
+            delay = min(maxdelay, delay * 2 ** (self.failures - 1))
+            self.retryAt = now + random.uniform(delay / 2, delay)
+        else:
+            self.retryAt = now
+        self.failures += 1
+
+class BrokerConnection:
+    """One live broker connection subscribed to its share of destinations.
+       On failure it goes to the healthiest broker not backing off, ties
+       are broken by its own rotation of broker list."""
+    def __init__(self, reader, slot):
+        self.reader = reader
+        self.slot = slot
+        self.listener = DestListener(reader.pipeline, slot)
+        self.listener.onchange = reader.wake
+        reader.pipeline.ackers[slot] = self.listener.acker
+        self.conn = None
+        self.server, self.wasserver = None, None
+        self.tconn = None
+        self.deststr = ''
+        self.destinations = []
+        self.version = 1.0
+        self.connectDeadline, self.retryAt = 0, 0
+        self.upsince, self.downsince = None, monotonic()
+        self.downtotal = 0.0
+        self._slotlabels = (str(slot),)
+
+    def load(self, tupleserv, destinations, resubscribe=False):
+        """With resubscribe, destinations added or removed since the last
+           load are subscribed or unsubscribed on the live connection."""
         self.msgServers = deque(tupleserv)
+        self.msgServers.rotate(-self.slot)
+        wasdestinations, self.destinations = self.destinations, destinations
+        self.listener.load()
+        if resubscribe and self.conn and wasdestinations != destinations:
+            try:
+                for i, dest in wasdestinations:
+                    if (i, dest) not in destinations:
+                        self._unsubscribe(i, dest)
+                        sh.Logger.info('Unsubscribed from %s' % dest)
+                for i, dest in destinations:
+                    if (i, dest) not in wasdestinations:
+                        self._subscribe(i, dest)
+                        sh.Logger.info('Subscribed to %s' % dest)
+            except (socket.error, stomp.exception.NotConnectedException) as e:
+                # reconnect subscribes to the new destinations
+                sh.Logger.warning('Could not change subscriptions on broker %s:%i: %s' % (self.server[0], self.server[1], e))
+            self.deststr = ''.join([dest + ', ' for i, dest in destinations])
 
-        self.listenerIdleTimeout = sh.ConsumerConf.get_option('SubscriptionIdleMsgTimeout'.lower())
-        self.destinations = sh.ConsumerConf.get_option('SubscriptionDestinations'.lower())
-        self.useSSL = sh.ConsumerConf.get_option('STOMPUseSSL'.lower())
-        self.keepaliveidle = sh.ConsumerConf.get_option('STOMPTCPKeepAliveIdle'.lower())
-        self.keepaliveint = sh.ConsumerConf.get_option('STOMPTCPKeepAliveInterval'.lower())
-        self.keepaliveprobes = sh.ConsumerConf.get_option('STOMPTCPKeepAliveProbes'.lower())
-        self.reconnects = sh.ConsumerConf.get_option('STOMPReconnectAttempts'.lower())
-        self.SSLCertificate = sh.ConsumerConf.get_option('AuthenticationHostKey'.lower())
-        self.SSLKey = sh.ConsumerConf.get_option('AuthenticationHostCert'.lower())
-        self._hours = sh.ConsumerConf.get_option('GeneralReportWritMsgEveryHours'.lower(), optional=True)
-        self._nummsgs_evsec = 3600*float(self._hours) if self._hours else 3600*24
+    def _subscribe(self, i, dest):
+        if self.listener.acker.mode == 'auto' and self.version < 1.1:
+            self.conn.subscribe(destination=dest, ack='auto')
+        else:
+            self.conn.subscribe(destination=dest, ack=self.listener.acker.mode, id=str(i))
+
+    def _unsubscribe(self, i, dest):
+        if self.listener.acker.mode == 'auto' and self.version < 1.1:
+            self.conn.unsubscribe(destination=dest)
+        else:
+            self.conn.unsubscribe(id=str(i))
+
+    def _pickserver(self, now):
+        """Healthiest broker not backing off, None if all of them are."""
+        best = None
+        for server in self.msgServers:
+            health = self.reader.health(server)
+            if health.retryAt <= now and (best is None or health.score > best.score):
+                best = health
+        return best.server if best else None
 
     def connect(self):
-        # cycle msg server
-        self.server = self.msgServers[0]
+        reader = self.reader
+        now = monotonic()
+        server = self._pickserver(now)
+        if not server:
+            self.retryAt = min([reader.health(s).retryAt for s in self.msgServers])
+            return
+        while self.msgServers[0] != server:
+            self.msgServers.rotate(-1)
+        self.server = server
+        heartbeats = (reader.heartBeatSend, reader.heartBeatReceive)
+        version = 1.1 if self.listener.acker.mode == 'client-individual' or any(heartbeats) else 1.0
+        self.version = version
         self.conn = stomp.Connection([self.server],
                             keepalive=('linux',
-                                        self.keepaliveidle,
-                                        self.keepaliveint,
-                                        self.keepaliveprobes),
-                            reconnect_attempts_max=self.reconnects,
-                            use_ssl=self.useSSL,
-                            ssl_key_file=self.SSLKey,
-                            ssl_cert_file=self.SSLCertificate)
+                                        reader.keepaliveidle,
+                                        reader.keepaliveint,
+                                        reader.keepaliveprobes),
+                            reconnect_attempts_max=reader.reconnects,
+                            use_ssl=reader.useSSL,
+                            ssl_key_file=reader.SSLKey,
+                            ssl_cert_file=reader.SSLCertificate,
+                            heartbeats=heartbeats if version >= 1.1 else (0, 0),
+                            version=version)
         sh.Logger.info("Cycle to broker %s:%i" % (self.server[0], self.server[1]))
-        self._listconns.append(self.conn)
         self.msgServers.rotate(-1)
+        if self.wasserver:
+            metrics.reconnects.inc(labels=self._slotlabels)
         self.wasserver = self.server
 
         self.conn.set_listener('DestListener', self.listener)
+        self.listener.acker.setconn(self.conn)
 
         try:
             self.deststr = ''
+            self.listener.connecting = True
+            self.connectDeadline = now + connectTimeout
             self.conn.start()
             self.conn.connect()
-            for dest in self.destinations:
-                self.conn.subscribe(destination=dest, ack='auto')
+            for i, dest in self.destinations:
+                self._subscribe(i, dest)
                 self.deststr = self.deststr + dest + ', '
             sh.Logger.info('Subscribed to %s' % (self.deststr[:len(self.deststr) - 2]))
-            self.listener.connectedCounter = 100
-            self.tconn = time.time()
         except:
             sh.Logger.error('Connection to broker %s:%i failed after %i retries' % (self.server[0], self.server[1],
-                                                                            self.reconnects))
-            self.listener.connectedCounter = 10
+                                                                            reader.reconnects))
+            self.listener.connecting = False
+            self.failed(monotonic())
+
+    def up(self, now):
+        """Listener got connected, account time spent without connection."""
+        self.upsince = now
+        self.tconn = time.time()
+        if self.downsince is not None:
+            self.downtotal += now - self.downsince
+            metrics.disconnected.inc(now - self.downsince, self._slotlabels)
+            self.downsince = None
+        self.reader.health(self.server).succeeded()
+
+    def failed(self, now):
+        """Connection failed, dropped or went idle, back off its broker.
+           Next attempt is due once some broker is not backing off."""
+        reader = self.reader
+        if self.downsince is None:
+            self.downsince = now
+        stable = self.upsince is not None and now - self.upsince >= stableConnection
+        self.upsince = None
+        if self.server:
+            health = reader.health(self.server)
+            health.failed(now, stable, reader.reconnectDelay, reader.reconnectMaxDelay)
+        self.retryAt = max(now, min([reader.health(s).retryAt for s in self.msgServers]))
+
+    def check(self, idletimeout, now):
+        """Time of next check of this connection and whether it needs to
+           be reconnected now."""
+        listener = self.listener
+        if listener.connected:
+            if self.upsince is None:
+                self.up(now)
+            if idletimeout > 0:
+                idleat = max(listener.lastrecv, self.upsince) + idletimeout
+                if now >= idleat:
+                    sh.Logger.info('Listener did not receive any message in %s seconds' % idletimeout)
+                    self.failed(now)
+                    return None, True
+                return idleat, False
+            return None, False
+        if self.upsince is not None or listener.connecting and now >= self.connectDeadline:
+            self.failed(now)
+            return None, True
+        if listener.connecting:
+            return self.connectDeadline, False
+        if now < self.retryAt:
+            return self.retryAt, False
+        return None, True
+
+    def disconnect(self):
+        if self.conn:
+            try:
+                self.conn.stop()
+                self.conn.disconnect()
+            except (socket.error, stomp.exception.NotConnectedException):
+                sh.Logger.info('Disconnected: %s:%i' % (self.wasserver[0], self.wasserver[1]))
+            self.listener.connected = False
+            self.listener.connecting = False
+            self.conn = None
+        if self.downsince is None:
+            self.downsince = monotonic()
+        self.upsince = None
+
+class MessageReader:
+    def __init__(self):
+        self.pipeline = MessagePipeline()
+        self.conns = []
+        self._wastupleserv = None
+        self._wasconnparams = None
+        self._reconnconfreload = False
+        self._reloadwanted = False
+        self._destids, self._destslots, self._nextdestid = {}, {}, 0
+        self.metricsServer = None
+        self._nummsgbase = 0
+        self._wakeup, self._reportwakeup = Waker(), Waker()
+        self.brokers = {}
+        self._lastreport = monotonic()
+        self.load()
+
+    def load(self):
+        """Connections are reestablished only if broker, SSL or STOMP
+           settings changed, changed destinations are subscribed on the live
+           connections."""
+        tupleserv = sh.ConsumerConf.get_option('BrokerServer'.lower())
+        self._wastupleserv = tupleserv
+
+        self.listenerIdleTimeout = sh.ConsumerConf.get_option('SubscriptionIdleMsgTimeout'.lower())
+        self.destinations = sh.ConsumerConf.get_option('SubscriptionDestinations'.lower())
+        numconns = sh.ConsumerConf.get_option('SubscriptionConnections'.lower(), optional=True)
+        self.numconns = min(numconns, len(self.destinations)) if numconns else 1
+        self.useSSL = sh.ConsumerConf.get_option('STOMPUseSSL'.lower())
+        self.keepaliveidle = sh.ConsumerConf.get_option('STOMPTCPKeepAliveIdle'.lower())
+        self.keepaliveint = sh.ConsumerConf.get_option('STOMPTCPKeepAliveInterval'.lower())
+        self.keepaliveprobes = sh.ConsumerConf.get_option('STOMPTCPKeepAliveProbes'.lower())
+        self.reconnects = sh.ConsumerConf.get_option('STOMPReconnectAttempts'.lower())
+        heartbeatsend = sh.ConsumerConf.get_option('STOMPHeartBeatSend'.lower(), optional=True)
+        heartbeatreceive = sh.ConsumerConf.get_option('STOMPHeartBeatReceive'.lower(), optional=True)
+        reconnectdelay = sh.ConsumerConf.get_option('STOMPReconnectDelay'.lower(), optional=True)
+        reconnectmaxdelay = sh.ConsumerConf.get_option('STOMPReconnectMaxDelay'.lower(), optional=True)
+        self.heartBeatSend = heartbeatsend if heartbeatsend else 0
+        self.heartBeatReceive = heartbeatreceive if heartbeatreceive else 0
+        self.reconnectDelay = (reconnectdelay if reconnectdelay else defaultReconnectDelay) / 1000.0
+        self.reconnectMaxDelay = (reconnectmaxdelay if reconnectmaxdelay else defaultReconnectMaxDelay) / 1000.0
+        self.SSLCertificate = sh.ConsumerConf.get_option('AuthenticationHostKey'.lower())
+        self.SSLKey = sh.ConsumerConf.get_option('AuthenticationHostCert'.lower())
+        self._hours = sh.ConsumerConf.get_option('GeneralReportWritMsgEveryHours'.lower(), optional=True)
+        self._nummsgs_evsec = 3600*float(self._hours) if self._hours else 3600*24
+        connparams = (tupleserv, self.useSSL, self.SSLKey, self.SSLCertificate, self.keepaliveidle,
+                      self.keepaliveint, self.keepaliveprobes, self.reconnects, self.heartBeatSend,
+                      self.heartBeatReceive, sh.ConsumerConf.get_option('STOMPAckMode'.lower(), optional=True))
+        self._reconnconfreload = self._wasconnparams is not None and connparams != self._wasconnparams
+        self._wasconnparams = connparams
+        self._assigndests()
+
+        listen = sh.ConsumerConf.get_option('MetricsListen'.lower(), optional=True)
+        if self.metricsServer and self.metricsServer.listen != listen:
+            self.metricsServer.close()
+            self.metricsServer = None
+        if listen and not self.metricsServer:
+            try:
+                self.metricsServer = MetricsServer(listen)
+            except (IOError, OSError, socket.error) as e:
+                sh.Logger.error('Metrics endpoint %s: %s' % (listen, e))
+                raise SystemExit(1)
+
+        resubscribe = not self._reconnconfreload and len(self.conns) == self.numconns
+        for bc in self.conns:
+            bc.load(tupleserv, self._destshare(bc.slot), resubscribe)
+        self.wake()
+
+    def _assigndests(self):
+        """Destinations kept across reload keep their connection and
+           subscription id, new ones go to the connection with the fewest
+           destinations under id never used before. Changed number of connections spreads all of them
+           anew."""
+        ids, slots = {}, {}
+        if len(self.conns) != self.numconns:
+            for i, dest in enumerate(self.destinations):
+                ids[dest], slots[dest] = i, i % self.numconns
+            self._nextdestid = len(self.destinations)
+        else:
+            nslot = [0] * self.numconns
+            for dest in self.destinations:
+                if dest in self._destids:
+                    ids[dest], slots[dest] = self._destids[dest], self._destslots[dest]
+                    nslot[slots[dest]] += 1
+            for dest in self.destinations:
+                if dest not in ids:
+                    slot = nslot.index(min(nslot))
+                    ids[dest], slots[dest] = self._nextdestid, slot
+                    self._nextdestid += 1
+                    nslot[slot] += 1
+        self._destids, self._destslots = ids, slots
+
+    def _destshare(self, slot):
+        return [(self._destids[dest], dest) for dest in self.destinations
+                if self._destslots[dest] == slot]
+
+    def _setupconns(self):
+        self.disconnect()
+        self.conns = []
+        self.pipeline.ackers.clear()
+        self._assigndests()
+        for slot in range(self.numconns):
+            bc = BrokerConnection(self, slot)
+            bc.load(self._wastupleserv, self._destshare(slot))
+            self.conns.append(bc)
+
+    def disconnect(self):
+        for bc in self.conns:
+            bc.disconnect()
+        self.wake()
+
+    def close(self):
+        """Stop taking messages, write and acknowledge the queued ones and
+           disconnect. Connections in client ack modes stay up while
+           pipeline is closed so messages written on close are acknowledged,
+           messages they receive meanwhile are left to broker to deliver
+           again."""
+        self.pipeline.closing = True
+        for bc in self.conns:
+            if bc.listener.acker.mode == 'auto':
+                bc.disconnect()
+        try:
+            self.pipeline.close()
+        finally:
+            self.disconnect()
+
+    def reload(self):
+        """Ask supervisor loop to reload config, safe to call from signal
+           handler."""
+        self._reloadwanted = True
+        self._wakeup.set()
+
+    def _apply(self):
+        self.load()
+        return self.pipeline.reload()
+
+    def _reload(self):
+        """Parse config and apply only what changed. Broker connections
+           stay up unless their settings changed, writers are paused only
+           while they load. Config that fails to apply, e.g. on metrics
+           endpoint that can not be bound, is rolled back to the previous
+           snapshot."""
+        start = monotonic()
+        old = sh.ConsumerConf.snapshot()
+        if not sh.ConsumerConf.parse():
+            return
+        changed = old.diff(sh.ConsumerConf.snapshot())
+        if not changed:
+            sh.Logger.info('Config reload, nothing changed')
+            return
+        try:
+            pause = self._apply()
+        except SystemExit:
+            sh.Logger.error('Config %s not applied, keeping the previous one' % old.filename)
+            sh.ConsumerConf.swap(old)
+            self._apply()
+            return
+        metrics.reloadpause.observe(pause)
+        sh.Logger.info('Config reload of %s in %.1f ms, writers paused %.1f ms%s' %
+                       (', '.join(changed), 1000 * (monotonic() - start), 1000 * pause,
+                        ', reconnecting' if self._reconnconfreload else ''))
+
+    def health(self, server):
+        if server not in self.brokers:
+            self.brokers[server] = BrokerHealth(server)
+        return self.brokers[server]
+
+    def wake(self):
+        """Make supervisor and report thread look at connections and
+           events again."""
+        self._wakeup.set()
+        self._reportwakeup.set()
+
+    def _nummsg(self):
+        return metrics.written.value() - self._nummsgbase
 
     def _deferwritmsgreport(self):
-        s = 0
         while True:
             if sh.eventusr1.isSet():
                 now = time.time()
                 dur = now - sh.stime
-                sh.Logger.info('Connected to %s:%i for %.2f hours' % (self.server[0], self.server[1], (now - self.tconn)/3600))
-                sh.Logger.info('Subscribed to %s' % (self.deststr[:len(self.deststr) - 2]))
+                for bc in self.conns:
+                    if bc.listener.connected:
+                        sh.Logger.info('Connected to %s:%i for %.2f hours' % (bc.server[0], bc.server[1], (now - bc.tconn)/3600))
+                        sh.Logger.info('Subscribed to %s' % (bc.deststr[:len(bc.deststr) - 2]))
                 sh.Logger.info('Written %i messages in %.2f hours' %
-                            (sh.nummsg, dur/3600 if dur/3600 < float(self._hours) else float(self._hours)))
+                            (self._nummsg(), dur/3600 if dur/3600 < float(self._hours) else float(self._hours)))
+                mnow = monotonic()
+                for bc in self.conns:
+                    down = bc.downtotal + (mnow - bc.downsince if bc.downsince is not None else 0)
+                    sh.Logger.info('Connection %i disconnected for %.1f s in total' % (bc.slot, down))
+                for server, health in sorted(self.brokers.items()):
+                    sh.Logger.info('Broker %s:%i health %.2f, %i connections, %i failures, retry in %.1f s' %
+                                   (server[0], server[1], health.score, health.nconnects, health.nfailures,
+                                    max(health.retryAt - mnow, 0)))
+                sh.Logger.info(self.pipeline.queue.stats())
+                sh.Logger.info(self.pipeline.writer.stats())
+                if self.pipeline.spool:
+                    sh.Logger.info(self.pipeline.spool.stats())
+                sh.Logger.info(self.pipeline.dedup.stats())
                 sh.eventusr1.clear()
             if sh.eventterm.isSet():
                 dur = time.time() - sh.stime
                 sh.Logger.info('Written %i messages in %.2f hours' %
-                            (sh.nummsg, dur/3600 if dur/3600 < float(self._hours) else float(self._hours)))
+                            (self._nummsg(), dur/3600 if dur/3600 < float(self._hours) else float(self._hours)))
                 break
-            if s < self._nummsgs_evsec:
-                sh.eventterm.wait(2.0)
-                s += 2
-            else:
-                if self.listener.connected:
+            timeout = self._lastreport + self._nummsgs_evsec - monotonic()
+            if timeout <= 0:
+                if [bc for bc in self.conns if bc.listener.connected]:
+                    written = metrics.written.value()
                     sh.Logger.info('Written %i messages in %.2f hours' %
-                                (sh.nummsg, float(self._hours)))
-                    sh.nummsg, s = 0, 0
+                                (written - self._nummsgbase, float(self._hours)))
+                    self._nummsgbase = written
+                    self._lastreport = monotonic()
                     sh.stime = time.time()
+                    continue
+                # report once some connection is up again
+                timeout = None
+            self._reportwakeup.wait(timeout)
 
     def run(self):
-        # loop
-        self.listener.connectedCounter = 0
-        loopCount = 0
-
         self.th = threading.Thread(target=self._deferwritmsgreport, name='msgwritreport_thread')
         self.th.start()
 
-        while True:
-            self.reconnect = False
-
-            #check connection
-            if not self.listener.connected:
-                self.listener.connectedCounter -= 1
-                self.reconnect = True
-
-            else:
-                if self.listenerIdleTimeout > 0 and loopCount >= self.listenerIdleTimeout:
-                    if not sh.nummsg > 0:
-                        self.reconnect = True
-                        loopCount = 0
-                        sh.nummsg = 0
-                        sh.Logger.info('Listener did not receive any message in %s seconds' % self.listenerIdleTimeout)
-
-            if self.reconnect or self._reconnconfreload:
-                if self._listconns:
-                    for conn in self._listconns:
-                        try:
-                            conn.stop()
-                            conn.disconnect()
-                        except (socket.error, stomp.exception.NotConnectedException):
-                            sh.Logger.info('Disconnected: %s:%i' % (self.wasserver[0], self.wasserver[1]))
-                            self.listener.connected = False
-                            self._reconnconfreload = False
-                    self._listconns = []
-                self.connect()
-
-            loopCount += 1
-            time.sleep(1)
+        while not sh.eventterm.isSet():
+            if self._reloadwanted:
+                self._reloadwanted = False
+                try:
+                    self._reload()
+                except SystemExit:
+                    # previous config could not be applied back either,
+                    # report thread ends on eventterm
+                    sh.eventterm.set()
+                    self.close()
+                    raise
+
+            if len(self.conns) != self.numconns:
+                self._setupconns()
+
+            nextcheck = None
+            for bc in self.conns:
+                deadline, reconnect = bc.check(self.listenerIdleTimeout, monotonic())
+
+                if reconnect or self._reconnconfreload:
+                    bc.disconnect()
+                    bc.connect()
+                    deadline, reconnect = bc.check(self.listenerIdleTimeout, monotonic())
+                    if reconnect:
+                        # attempt failed and some broker can be retried now
+                        deadline = monotonic()
+
+                if deadline is not None and (nextcheck is None or deadline < nextcheck):
+                    nextcheck = deadline
+
+            self._reconnconfreload = False
+            if not sh.eventterm.isSet():
+                self._wakeup.wait(nextcheck - monotonic() if nextcheck is not None else None)
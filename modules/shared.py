@@ -1,9 +1,21 @@
+import os
+import signal
+
 class SingletonShared:
     def __init__(self):
-        for attr in ['ConsumerConf', 'Logger', 'thlock', 'eventterm', 'stime', 'eventusr1']:
+        for attr in ['ConsumerConf', 'Logger', 'eventterm', 'stime', 'eventusr1']:
             if getattr(self.__class__, attr, None):
                 code = """self.%s = self.__class__.%s""" % (attr, attr)
                 exec code
 
     def seta(self, attr, value):
         setattr(self.__class__, attr, value)
+
+def shutdown():
+    """Stop the daemon on fatal error in thread other than main one, where
+       SystemExit would end only that thread. Main thread gets SIGTERM and
+       closes everything as on regular stop."""
+    eventterm = getattr(SingletonShared, 'eventterm', None)
+    if eventterm:
+        eventterm.set()
+    os.kill(os.getpid(), signal.SIGTERM)
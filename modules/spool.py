@@ -0,0 +1,242 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import cPickle
+import glob
+import os
+import struct
+import threading
+import time
+import zlib
+from argo_egi_consumer.shared import SingletonShared as Shared
+from argo_egi_consumer.shared import shutdown
+
+defaultSpoolSyncInterval = 50
+defaultSpoolSegmentSize = 64*1024*1024
+defaultSpoolSegmentSeconds = 5
+RECHEADER = struct.Struct('>II')
+
+sh = Shared()
+
+class MessageSpool:
+    """Write-ahead log of received frames. Frames are appended to memory
+       buffer and written with one write and fsync by spool thread every
+       SyncInterval ms. Records are length prefixed and carry CRC32 of
+       payload so that torn tail left by crash is detected. Spool is split
+       in segments and segment is removed once all of its messages are
+       flushed to day files. New segment is started once the live one
+       reaches SegmentSize bytes, gets SegmentSeconds old or has all its
+       messages flushed, so that replay of segments left from previous run
+       on startup writes again only few messages already in day files."""
+    def __init__(self, spoolfile):
+        self.spoolFile = spoolfile
+        self._lock = threading.Lock()
+        self._buf, self._bufsize = [], 0
+        self._outstanding = {}
+        self._closedsegs = set()
+        self._file, self._fileseg, self._size = None, None, 0
+        self._segstart = 0
+        self._closed = False
+        self.ncommits, self.nrecords, self.commitsum, self.commitmax = 0, 0, 0.0, 0.0
+        self.load()
+        segs = self._segments()
+        self._seg = segs[-1] + 1 if segs else 0
+        self._outstanding[self._seg] = 0
+        self._wake = threading.Event()
+        self.th = threading.Thread(target=self._commitloop, name='spool_thread')
+        self.th.daemon = True
+        self.th.start()
+
+    def load(self):
+        interval = sh.ConsumerConf.get_option('SpoolSyncInterval'.lower(), optional=True)
+        segsize = sh.ConsumerConf.get_option('SpoolSegmentSize'.lower(), optional=True)
+        segsecs = sh.ConsumerConf.get_option('SpoolSegmentSeconds'.lower(), optional=True)
+        self.syncInterval = (interval if interval is not None else defaultSpoolSyncInterval) / 1000.0
+        self.segmentSize = segsize if segsize else defaultSpoolSegmentSize
+        self.segmentSeconds = segsecs if segsecs else defaultSpoolSegmentSeconds
+
+    def _segname(self, seg):
+        return '%s.%08d' % (self.spoolFile, seg)
+
+    def _segments(self):
+        segs = []
+        for name in glob.glob(self.spoolFile + '.*'):
+            suffix = name[len(self.spoolFile) + 1:]
+            if suffix.isdigit():
+                segs.append(int(suffix))
+        return sorted(segs)
+
+    def append(self, headers, body, token):
+        """Buffer frame for next group commit and return token, created if
+           None, that is passed to durable() once message is written."""
+        payload = cPickle.dumps((headers, body), 2)
+        rec = RECHEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        token = token if token else {'slot': None}
+        self._lock.acquire()
+        try:
+            token['spool'] = self._seg
+            self._outstanding[self._seg] += 1
+            self._buf.append(rec)
+            self._bufsize += len(rec)
+        finally:
+            self._lock.release()
+        return token
+
+    def replay(self, put):
+        """Pass every frame from segments left by previous run to put as
+           headers, body and token. Reading of segment stops at the first
+           torn or corrupted record."""
+        for seg in self._segments():
+            if seg >= self._seg:
+                continue
+            self._lock.acquire()
+            self._outstanding[seg] = 0
+            self._lock.release()
+            nrecs = 0
+            try:
+                segfile = open(self._segname(seg), 'rb')
+                while True:
+                    header = segfile.read(RECHEADER.size)
+                    if len(header) < RECHEADER.size:
+                        break
+                    length, crc = RECHEADER.unpack(header)
+                    payload = segfile.read(length)
+                    if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                        sh.Logger.warning('Spool %s corrupted after %i records' % (self._segname(seg), nrecs))
+                        break
+                    headers, body = cPickle.loads(payload)
+                    self._lock.acquire()
+                    self._outstanding[seg] += 1
+                    self._lock.release()
+                    put(headers, body, {'slot': None, 'spool': seg})
+                    nrecs += 1
+                segfile.close()
+            except (IOError, OSError, cPickle.UnpicklingError) as e:
+                sh.Logger.error(e)
+                raise SystemExit(1)
+            sh.Logger.info('Replayed %i messages from spool %s' % (nrecs, self._segname(seg)))
+            self._lock.acquire()
+            self._closedsegs.add(seg)
+            self._lock.release()
+            self._release()
+
+    def durable(self, tokens):
+        """Messages of tokens are flushed to day files, segments with no
+           outstanding messages left are removed."""
+        self._lock.acquire()
+        try:
+            for token in tokens:
+                if token and 'spool' in token:
+                    self._outstanding[token['spool']] -= 1
+        finally:
+            self._lock.release()
+        self._release()
+
+    def _release(self):
+        self._lock.acquire()
+        try:
+            done = [seg for seg in self._closedsegs if not self._outstanding[seg]]
+            for seg in done:
+                self._closedsegs.discard(seg)
+                del self._outstanding[seg]
+        finally:
+            self._lock.release()
+        try:
+            for seg in done:
+                os.remove(self._segname(seg))
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+
+    def _commit(self):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            buf, seg = self._buf, self._seg
+            self._buf, self._bufsize = [], 0
+            if buf:
+                if not self._size:
+                    self._segstart = now
+                self._size += sum([len(rec) for rec in buf])
+            if self._size and (self._size >= self.segmentSize or not self._outstanding[seg] or
+                               now - self._segstart >= self.segmentSeconds):
+                self._seg += 1
+                self._outstanding[self._seg] = 0
+                self._size = 0
+        finally:
+            self._lock.release()
+
+        if not buf and seg == self._seg and not (self._closed and self._file):
+            return
+        start = time.time()
+        try:
+            if self._fileseg != seg:
+                self._file = open(self._segname(seg), 'ab')
+                self._fileseg = seg
+            if buf:
+                self._file.write(''.join(buf))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            if seg != self._seg or self._closed:
+                self._file.close()
+                self._file, self._fileseg = None, None
+                self._lock.acquire()
+                self._closedsegs.add(seg)
+                self._lock.release()
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+        dur = time.time() - start
+        self.ncommits += 1
+        self.nrecords += len(buf)
+        self.commitsum += dur
+        if dur > self.commitmax:
+            self.commitmax = dur
+        self._release()
+
+    def _commitloop(self):
+        try:
+            while not self._closed:
+                self._wake.wait(self.syncInterval)
+                self._wake.clear()
+                self._commit()
+        except SystemExit:
+            shutdown()
+
+    def close(self):
+        """Commit buffered frames and remove spool if every message got
+           flushed to day files."""
+        self._closed = True
+        self._wake.set()
+        self.th.join()
+        self._commit()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return 'Spool commits %i, records %i, avg commit %.3f s, max commit %.3f s, outstanding %i' % \
+                (self.ncommits, self.nrecords, self.commitsum/self.ncommits if self.ncommits else 0.0,
+                 self.commitmax, sum(self._outstanding.values()))
+        finally:
+            self._lock.release()
@@ -0,0 +1,180 @@
+
+# Copyright (c) 2013 GRNET S.A., SRCE, IN2P3 CNRS Computing Centre
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language
+# governing permissions and limitations under the License.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be
+# interpreted as representing official policies, either expressed
+# or implied, of either GRNET S.A., SRCE or IN2P3 CNRS Computing
+# Centre
+#
+# The work represented by this source file is partially funded by
+# the EGI-InSPIRE project through the European Commission's 7th
+# Framework Programme (contract # INFSO-RI-261323)
+
+import Queue
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import zlib
+from argo_egi_consumer.writer import MessageWriter
+from argo_egi_consumer.shared import SingletonShared as Shared
+from argo_egi_consumer import msgparser
+
+defaultShardBy = 'hostname'
+SHARDFIELDS = {'hostname': 'hostName', 'day': 'timestamp'}
+workerJoinTimeout = 30
+
+sh = Shared()
+
+def _workermain(shard, inq, outq, ppid):
+    """Encoder worker: parses and writes frames of its shard with its own
+       MessageWriter and passes back sequence numbers of durable frames.
+       Shutdown is driven by the receiver, worker exits on its own only if
+       the receiver is gone."""
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_IGN)
+    sh.seta('eventterm', threading.Event())
+    writer = MessageWriter(shard)
+    writer.setDurableCallback(lambda seqs: outq.put([seq for seq in seqs if seq]))
+    while True:
+        # set only by shutdown() of failed flush thread, worker exits
+        # with error and receiver stops the daemon
+        if sh.eventterm.isSet():
+            raise SystemExit(1)
+        try:
+            item = inq.get(True, 1.0)
+        except Queue.Empty:
+            if os.getppid() != ppid:
+                break
+            continue
+        if item is None:
+            break
+        elif item[0] == 'load':
+            sh.ConsumerConf.swap(item[1])
+            writer.load()
+        else:
+            writer.writeFrames(*item)
+    sh.eventterm.set()
+    writer.pool.th.join(workerJoinTimeout)
+    writer.close()
+    outq.put(('exit', shard))
+
+class WorkerPool:
+    """Receiver side of encoder worker processes. Frames are routed to
+       workers by hash of hostName or of day of the result, so every output
+       file is written by one worker only and keeps order of messages.
+       Tokens stay in receiver, workers see only their sequence numbers."""
+    def __init__(self, nworkers):
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._seq = itertools.count(1)
+        self.ondurable = None
+        self.nsent = 0
+        self.load()
+        self._outq = multiprocessing.Queue()
+        self._inqs, self._procs = [], []
+        for i in range(nworkers):
+            inq = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_workermain, name='encoder-%d' % i,
+                                           args=(i, inq, self._outq, os.getpid()))
+            proc.daemon = True
+            proc.start()
+            self._inqs.append(inq)
+            self._procs.append(proc)
+        self._closing = False
+        self.th = threading.Thread(target=self._collect, name='encodercollect_thread')
+        self.th.daemon = True
+        self.th.start()
+
+    def load(self):
+        shardby = sh.ConsumerConf.get_option('WorkersShardBy'.lower(), optional=True)
+        self.shardBy = shardby.lower() if shardby else defaultShardBy
+        snapshot = sh.ConsumerConf.snapshot()
+        for inq in getattr(self, '_inqs', []):
+            inq.put(('load', snapshot))
+
+    def setDurableCallback(self, callback):
+        self.ondurable = callback
+
+    def _shard(self, headers, body):
+        value = msgparser.field(headers, body, SHARDFIELDS[self.shardBy])
+        if not value:
+            return 0
+        if self.shardBy == 'day':
+            value = value[:10]
+        return (zlib.crc32(value) & 0xffffffff) % len(self._inqs)
+
+    def writeFrames(self, frames, tokens=None):
+        tokens = tokens or [None] * len(frames)
+        shards = [([], []) for inq in self._inqs]
+        self._lock.acquire()
+        try:
+            for frame, token in zip(frames, tokens):
+                seq = 0
+                if token:
+                    seq = next(self._seq)
+                    self._tokens[seq] = token
+                shardframes, shardseqs = shards[self._shard(*frame)]
+                shardframes.append(frame)
+                shardseqs.append(seq)
+            self.nsent += len(frames)
+        finally:
+            self._lock.release()
+        for inq, (shardframes, shardseqs) in zip(self._inqs, shards):
+            if shardframes:
+                inq.put((shardframes, shardseqs))
+
+    def _collect(self):
+        exited = set()
+        while len(exited) < len(self._procs):
+            try:
+                item = self._outq.get(True, 1.0)
+            except Queue.Empty:
+                dead = [proc for i, proc in enumerate(self._procs)
+                        if i not in exited and not proc.is_alive()]
+                if dead and not self._closing:
+                    sh.Logger.error('Encoder worker %s exited with %s' % (dead[0].name, dead[0].exitcode))
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+                continue
+            if isinstance(item, tuple):
+                exited.add(item[1])
+                continue
+            self._lock.acquire()
+            tokens = [self._tokens.pop(seq, None) for seq in item]
+            self._lock.release()
+            if self.ondurable:
+                self.ondurable(tokens)
+
+    def close(self):
+        self._closing = True
+        for inq in self._inqs:
+            inq.put(None)
+        deadline = time.time() + workerJoinTimeout
+        for proc in self._procs:
+            proc.join(max(deadline - time.time(), 0))
+        self.th.join(max(deadline - time.time(), 0))
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return 'Encoder workers %i alive of %i, shard by %s, %i frames sent, %i waiting to be flushed' % \
+                (len([p for p in self._procs if p.is_alive()]), len(self._procs), self.shardBy,
+                 self.nsent, len(self._tokens))
+        finally:
+            self._lock.release()
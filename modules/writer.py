@@ -24,7 +24,10 @@
 # Framework Programme (contract # INFSO-RI-261323)
 
 import avro.schema
+import cStringIO
 import datetime
+import glob
+import hashlib
 import json
 import logging
 import os
@@ -34,16 +37,55 @@ import sys
 import threading
 import time
 import re
+import zlib
 
 from argo_egi_consumer.shared import SingletonShared as Shared
+from argo_egi_consumer.shared import shutdown
+from argo_egi_consumer import avroencoder
+from argo_egi_consumer import dayindex
+from argo_egi_consumer import msgparser
+from argo_egi_consumer import metrics
 from avro.datafile import DataFileReader
 from avro.datafile import DataFileWriter
+from avro.datafile import SYNC_INTERVAL
+from avro.io import BinaryEncoder
 from avro.io import DatumReader
 from avro.io import DatumWriter
 from os import path
 
+try:
+    import ujson
+    def jsondumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+except ImportError:
+    jsondumps = json.JSONEncoder(separators=(',', ':')).encode
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 defaultFileLogPastDays = 1
 defaultFileLogFutureDays = 1
+defaultFlushEveryRecords = 1000
+defaultFlushEveryBytes = 1024*1024
+defaultFlushEverySeconds = 5
+defaultIdleFileTimeout = 600
+defaultFsyncPolicy = 'none'
+defaultFsyncEveryRecords = 10000
+defaultFsyncEveryMs = 1000
+FSYNCPOLICIES = ['none', 'records', 'interval', 'close']
+defaultCodec = 'null'
+defaultBlockSize = SYNC_INTERVAL
+AVROLABELS = ('avro',)
+PLAINTEXTLABELS = ('plaintext',)
+TMPEXT = '.tmp'
+defaultPlaintextCompression = 'none'
+PTXTCOMPRESSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+gzipLevel = 6
+zstdLevel = 3
+maxCachedNames = 1024
+TIMERE = re.compile(r'T([01]\d|2[0-3]):[0-5]\d:[0-5]\dZ$')
 LOGFORMAT = '%(name)s[%(process)s]: %(levelname)s %(message)s'
 
 sh = Shared()
@@ -63,6 +105,16 @@ class MsgLogger:
         self.rootlog.addHandler(handler)
         self.rootlog.propagate = False
 
+    def rename(self, name):
+        """Log under name set in config, read after logger is created."""
+        mylog = logging.getLogger(name)
+        mylog.setLevel(self.mylog.level)
+        for hdlr in self.mylog.handlers[:]:
+            self.mylog.removeHandler(hdlr)
+            mylog.addHandler(hdlr)
+        mylog.propagate = False
+        self.mylog = mylog
+
     def error(self, msg):
         self.mylog.error(msg)
 
@@ -79,100 +131,769 @@ class MsgLogger:
         self.mylog.removeHandler(hdlr)
 
 
-class MessageWriter:
+class MetricDatumWriter(DatumWriter):
+    """Writes ServiceViews of MetricResults directly. Views are built only
+       from results with all mandatory fields so validation of whole datum
+       against schema is skipped. Views of schema shape supported by
+       avroencoder are encoded by compiled encoder to same bytes."""
+    def __init__(self, writers_schema=None):
+        DatumWriter.__init__(self, writers_schema)
+        self._compiledSchema, self._compiled = None, None
+
+    def compiled(self):
+        """Compiled encode(datum) for writers schema, None if schema is
+           not supported."""
+        if self._compiledSchema is not self.writers_schema:
+            self._compiled = avroencoder.compile(self.writers_schema)
+            self._compiledSchema = self.writers_schema
+        return self._compiled
+
+    def write(self, datum, encoder):
+        if isinstance(datum, msgparser.ServiceView):
+            self.write_data(self.writers_schema, datum, encoder)
+        else:
+            DatumWriter.write(self, datum, encoder)
+
+
+class AvroWriterPool:
+    """Keeps DataFileWriters of day files open across messages. Writers are
+       keyed by output filename and their blocks are flushed when number of
+       records, size of buffered data or time since last flush reaches
+       configured threshold. Day files not written to for IdleFileTimeout
+       seconds are closed. Records are encoded without holding any lock,
+       only appending encoded records to the block of a given day file is
+       serialized with the lock of that file.
+
+       With records or interval FsyncPolicy flushed day files are fsynced
+       together by flush thread, group commit, and messages are passed to
+       ondurable only once fsynced. With close policy day file is fsynced
+       only when it is closed.
+
+       In partitioned output, filename template with HOUR or SEQ, files
+       are written under temporary name renamed once closed. SEQ is
+       replaced with the next free part number every time the file is
+       opened and the part is closed once it reaches MaxFileSize."""
     def __init__(self):
+        self._writers = {}
+        self._lock = threading.Lock()
+        self._durable = []
+        self._unsynced, self._lastsync = 0, time.time()
+        self._syncwanted = threading.Event()
+        self.nflushes, self.flushsum, self.flushmax = 0, 0.0, 0.0
+        self.nsyncs, self.syncsum, self.syncmax = 0, 0.0, 0.0
+        self.ondurable = None
+        self.avroSchema, self.schema = None, None
+        self._schemaMtime, self._schemaDigest = None, None
+        self._openSettings = None
         self.load()
+        self.onmaintain = None
+        self.th = threading.Thread(target=self._deferflush, name='avroflush_thread')
+        self.th.daemon = True
+        self.th.start()
 
     def load(self):
-        sh.ConsumerConf.parse()
-        self.dateFormat = '%Y-%m-%dT%H:%M:%SZ'
-        self.fileDirectory = sh.ConsumerConf.get_option('OutputDirectory'.lower())
-        self.filenameTemplate = sh.ConsumerConf.get_option('OutputFilename'.lower())
-        self.errorFilenameTemplate = sh.ConsumerConf.get_option('OutputErrorFilename'.lower())
-        self.avroSchema = sh.ConsumerConf.get_option('GeneralAvroSchema'.lower())
-        self.txtOutput = sh.ConsumerConf.get_option('GeneralWritePlaintext'.lower())
-        self.pastDaysOk = sh.ConsumerConf.get_option('MsgRetentionPastDaysOk'.lower())
-        self.futureDaysOk = sh.ConsumerConf.get_option('MsgRetentionFutureDaysOk'.lower())
-        self.logOutAllowedTime = sh.ConsumerConf.get_option('GeneralLogMsgOutAllowedTime'.lower())
-        self.logWrongFormat = sh.ConsumerConf.get_option('GeneralLogWrongFormat'.lower())
-
-    def _write_to_ptxt(self, log, fields, exten):
+        self._load_schema(sh.ConsumerConf.get_option('GeneralAvroSchema'.lower()))
+        flushrecords = sh.ConsumerConf.get_option('OutputFlushEveryRecords'.lower(), optional=True)
+        flushbytes = sh.ConsumerConf.get_option('OutputFlushEveryBytes'.lower(), optional=True)
+        flushsecs = sh.ConsumerConf.get_option('OutputFlushEverySeconds'.lower(), optional=True)
+        idletimeout = sh.ConsumerConf.get_option('OutputIdleFileTimeout'.lower(), optional=True)
+        self.flushRecords = flushrecords if flushrecords is not None else defaultFlushEveryRecords
+        self.flushBytes = flushbytes if flushbytes is not None else defaultFlushEveryBytes
+        self.flushSeconds = flushsecs if flushsecs is not None else defaultFlushEverySeconds
+        self.idleTimeout = idletimeout if idletimeout is not None else defaultIdleFileTimeout
+        policy = sh.ConsumerConf.get_option('OutputFsyncPolicy'.lower(), optional=True)
+        syncrecords = sh.ConsumerConf.get_option('OutputFsyncEveryRecords'.lower(), optional=True)
+        syncms = sh.ConsumerConf.get_option('OutputFsyncEveryMs'.lower(), optional=True)
+        self.fsyncPolicy = policy.lower() if policy else defaultFsyncPolicy
+        self.fsyncRecords = syncrecords if syncrecords else defaultFsyncEveryRecords
+        self.fsyncInterval = (syncms if syncms else defaultFsyncEveryMs) / 1000.0
+        codec = sh.ConsumerConf.get_option('OutputCodec'.lower(), optional=True)
+        blocksize = sh.ConsumerConf.get_option('OutputBlockSize'.lower(), optional=True)
+        self.codec = codec.lower() if codec else defaultCodec
+        self.blockSize = blocksize if blocksize else defaultBlockSize
+        self.index = sh.ConsumerConf.get_option('OutputIndex'.lower(), optional=True)
+        maxsize = sh.ConsumerConf.get_option('OutputMaxFileSize'.lower(), optional=True)
+        self.maxFileSize = maxsize if maxsize else 0
+        self.partitioned = False
+        # day files are closed only if settings they were opened with changed
+        opensettings = (self.codec, self.index)
+        if opensettings != self._openSettings:
+            self.close()
+        self._openSettings = opensettings
+
+    def _load_schema(self, avroschema):
+        """Parse schema only on first load or if schema file changed since
+           the last one. Changed schema is refused while day files written
+           with different one are still open."""
         try:
-            filename = '.'.join(log.split('.')[:-1]) + '.%s' % exten
-            plainfile = open(filename, 'a+')
-            plainfile.write(json.dumps(fields) + '\n')
-            plainfile.close()
+            mtime = path.getmtime(avroschema)
+            if avroschema == self.avroSchema and mtime == self._schemaMtime:
+                return
+            content = open(avroschema).read()
         except (IOError, OSError) as e:
             sh.Logger.error(e)
             raise SystemExit(1)
 
-    def _write_to_avro(self, log, fields):
-        msglist = []
-        msg, tags = {}, {}
-
-        msg = {'service': fields['serviceType'],
-               'timestamp': fields['timestamp'],
-               'hostname': fields['hostName'],
-               'metric': fields['metricName'],
-               'status': fields['metricStatus']}
-        msgattrmap = {'detailsData': 'message',
-                      'summaryData': 'summary',
-                      'nagios_host': 'monitoring_host'}
-        for attr in msgattrmap.keys():
-            if attr in fields:
-                msg[msgattrmap[attr]] = fields[attr]
-
-        tagattrmap = {'ROC': 'roc', 'voName': 'voName', 'voFqan': 'voFqan'}
-        for attr in tagattrmap.keys():
-            tags[tagattrmap[attr]] = fields.get(attr, None)
-        if tags:
-            msg['tags'] = tags
-
-        if ',' in fields['serviceType']:
-            servtype = fields['serviceType'].split(',')
-            msg['service'] = servtype[0].strip()
-            msglist.append(msg)
-            copymsg = msg.copy()
-            copymsg['service'] = servtype[1].strip()
-            msglist.append(copymsg)
-        else:
-            msglist.append(msg)
+        digest = hashlib.md5(content).hexdigest()
+        if digest == self._schemaDigest:
+            self.avroSchema, self._schemaMtime = avroschema, mtime
+            return
 
-        sh.thlock.acquire(True)
         try:
-            schema = avro.schema.parse(open(self.avroSchema).read())
-            if path.exists(log):
-                avroFile = open(log, 'a+')
-                writer = DataFileWriter(avroFile, DatumWriter())
+            schema = avro.schema.parse(content)
+        except avro.schema.SchemaParseException as e:
+            sh.Logger.error('Could not parse %s: %s' % (avroschema, e))
+            if not self.schema:
+                raise SystemExit(1)
+            return
+
+        if self.schema:
+            self._lock.acquire()
+            try:
+                # avro Schema defines __eq__ only, != would compare identity
+                incompat = [log for log, ent in self._writers.items()
+                            if 'datumwriter' in ent and not ent['datumwriter'].writers_schema == schema]
+            finally:
+                self._lock.release()
+            if incompat:
+                sh.Logger.error('Schema %s not reloaded, incompatible with opened %s' % (avroschema, ', '.join(incompat)))
+                return
+            sh.Logger.info('Schema %s reloaded' % avroschema)
+
+        self.avroSchema, self.schema = avroschema, schema
+        self._schemaMtime, self._schemaDigest = mtime, digest
+        self.datumWriter = MetricDatumWriter(schema)
+        if not self.datumWriter.compiled():
+            sh.Logger.info('Schema %s not supported by compiled encoder, records encoded with generic one' % avroschema)
+
+    def _partpath(self, log):
+        """Path file is written to and path it is renamed to once closed,
+           None if it is written in place."""
+        if 'SEQ' in log:
+            prefix, suffix = log.split('SEQ', 1)
+            seqs = []
+            for name in glob.glob(prefix + '[0-9]*' + suffix) + glob.glob(prefix + '[0-9]*' + suffix + TMPEXT):
+                seq = name[len(prefix):].split(suffix, 1)[0]
+                if not seq.isdigit():
+                    continue
+                seqs.append(int(seq))
+                if name.endswith(TMPEXT):
+                    # part left unfinished by crash
+                    os.rename(name, name[:-len(TMPEXT)])
+            final = prefix + '%04d' % (max(seqs) + 1 if seqs else 0) + suffix
+            return final + TMPEXT, final
+        elif self.partitioned and (path.exists(log + TMPEXT) or not path.exists(log)):
+            return log + TMPEXT, log
+        return log, None
+
+    def _open(self, log):
+        filepath, final = self._partpath(log)
+        name = final or filepath
+        if path.exists(filepath) and path.getsize(filepath) > 0:
+            avroFile = open(filepath, 'a+')
+            writer = DataFileWriter(avroFile, MetricDatumWriter())
+            index = dayindex.DayFileIndex(name) if self.index else None
+        else:
+            avroFile = open(filepath, 'w+')
+            writer = DataFileWriter(avroFile, self.datumWriter, self.schema, codec=self.codec)
+            # header written upfront so that file position is block offset
+            writer.flush()
+            index = dayindex.DayFileIndex(name, fresh=True) if self.index else None
+        now = time.time()
+        return {'file': avroFile, 'writer': writer, 'datumwriter': writer.datum_writer, 'index': index,
+                'path': filepath, 'final': final,
+                'records': 0, 'acks': [], 'syncacks': [], 'dirty': False,
+                'flushpos': avroFile.tell(),
+                'lastflush': now, 'lastused': now, 'closed': False}
+
+    def _entry(self, log):
+        """Opened writer of day file. File is opened holding only its own
+           lock so that other day files are not blocked meanwhile."""
+        while True:
+            self._lock.acquire()
+            try:
+                ent = self._writers.get(log)
+                opening = not ent
+                if opening:
+                    ent = {'lock': threading.Lock(), 'closed': True}
+                    ent['lock'].acquire()
+                    self._writers[log] = ent
+            finally:
+                self._lock.release()
+
+            if opening:
+                try:
+                    ent.update(self._open(log))
+                except:
+                    self._lock.acquire()
+                    self._writers.pop(log, None)
+                    self._lock.release()
+                    raise
+                finally:
+                    ent['lock'].release()
+                return ent
+
+            if 'writer' not in ent:
+                # wait for other thread to open it
+                ent['lock'].acquire()
+                ent['lock'].release()
+            if 'writer' in ent:
+                return ent
+
+    def _encode(self, datumwriter, msglist):
+        """Encoded records and offsets where each of them ends. Record the
+           compiled encoder fails on is encoded again with the generic one
+           that reports what is wrong with it."""
+        buf = cStringIO.StringIO()
+        encoder = BinaryEncoder(buf)
+        compiled = datumwriter.compiled()
+        ends = []
+        for m in msglist:
+            data = None
+            if compiled and isinstance(m, msgparser.ServiceView):
+                try:
+                    data = compiled(m)
+                except (AttributeError, TypeError, ValueError):
+                    pass
+            if data is not None:
+                buf.write(data)
+            else:
+                datumwriter.write(m, encoder)
+            ends.append(buf.tell())
+        return buf.getvalue(), ends
+
+    def _appendblocks(self, ent, msglist, data, ends):
+        """Append encoded records to blocks of day file, closing block
+           once it reaches BlockSize."""
+        writer, index = ent['writer'], ent['index']
+        room = self.blockSize - writer.buffer_writer.tell()
+        pos, first = 0, 0
+        for i, end in enumerate(ends):
+            if end - pos >= room or i == len(ends) - 1:
+                if index:
+                    index.add(*(dayindex.summarize(msglist[first:i+1]) + (i + 1 - first,)))
+                writer.buffer_writer.write(data[pos:end])
+                writer.block_count += i + 1 - first
+                if end - pos >= room:
+                    self._writeblock(ent, False)
+                    room = self.blockSize
+                pos, first = end, i + 1
+
+    def _pending(self, ent):
+        return ent['file'].tell() - ent['flushpos'] + ent['writer'].buffer_writer.tell()
+
+    def _writeblock(self, ent, flush):
+        offset = ent['file'].tell()
+        if flush:
+            ent['writer'].flush()
+        else:
+            ent['writer'].sync()
+        metrics.writtenbytes.inc(ent['file'].tell() - offset, AVROLABELS)
+        if ent['index']:
+            ent['index'].block(offset)
+            if flush:
+                ent['index'].flush()
+
+    def _flush(self, ent, now):
+        if ent['records'] > 0:
+            start = time.time()
+            self._writeblock(ent, True)
+            self._flushtime(time.time() - start)
+            ent['flushpos'] = ent['file'].tell()
+            if self.fsyncPolicy in ('records', 'interval'):
+                ent['syncacks'].extend(ent['acks'])
+                ent['dirty'] = True
+                self._lock.acquire()
+                self._unsynced += ent['records']
+                unsynced = self._unsynced
+                self._lock.release()
+                if self.fsyncPolicy == 'records' and unsynced >= self.fsyncRecords:
+                    self._syncwanted.set()
             else:
-                avroFile = open(log, 'w+')
-                writer = DataFileWriter(avroFile, DatumWriter(), schema)
+                self._adddurable(ent['acks'])
+            ent['records'] = 0
+            ent['acks'] = []
+        ent['lastflush'] = now
+
+    def _flushtime(self, dur):
+        metrics.flushtime.observe(dur)
+        self._lock.acquire()
+        self.nflushes += 1
+        self.flushsum += dur
+        if dur > self.flushmax:
+            self.flushmax = dur
+        self._lock.release()
+
+    def _close(self, log, ent):
+        """Called holding lock of day file. Entry stays registered until
+           its part is renamed, so that append to the same day file waits
+           on the lock instead of opening the part still being closed."""
+        ent['closed'] = True
+        try:
+            if 'writer' in ent:
+                self._writeblock(ent, True)
+                if self.fsyncPolicy != 'none':
+                    os.fsync(ent['file'].fileno())
+                ent['writer'].close()
+                if ent['index']:
+                    ent['index'].finalize()
+                if ent['final']:
+                    os.rename(ent['path'], ent['final'])
+                metrics.writetime.remove((os.path.basename(log),))
+                self._adddurable(ent['syncacks'] + ent['acks'])
+        finally:
+            self._lock.acquire()
+            try:
+                if self._writers.get(log) is ent:
+                    del self._writers[log]
+            finally:
+                self._lock.release()
+
+    def _adddurable(self, tokens):
+        if tokens:
+            self._lock.acquire()
+            self._durable.extend(tokens)
+            self._lock.release()
+
+    def _notifydurable(self):
+        """Called without any lock held to pass tokens of messages whose
+           records are flushed to the file."""
+        self._lock.acquire()
+        durable, self._durable = self._durable, []
+        self._lock.release()
+        if durable and self.ondurable:
+            self.ondurable(durable)
+
+    def _entries(self):
+        self._lock.acquire()
+        try:
+            return self._writers.items()
+        finally:
+            self._lock.release()
+
+    def append(self, batch, acks=None):
+        """Append records of batch, dict of filename and list of records.
+           Records are encoded outside of locks and appended to block of day
+           file holding its lock once per batch. acks holds per filename
+           tokens of messages that are passed to ondurable once flushed.
+           Records not fitting in part of MaxFileSize go to the next one
+           together with the tokens."""
+        try:
+            for log, msglist in batch.items():
+                start = time.time()
+                capped = self.maxFileSize and 'SEQ' in log
+                while msglist:
+                    ent = self._entry(log)
+                    data, ends = self._encode(ent['datumwriter'], msglist)
+                    ent['lock'].acquire()
+                    try:
+                        if ent['closed']:
+                            continue
+                        nrecs = len(msglist)
+                        if capped:
+                            room = self.maxFileSize - ent['file'].tell() - ent['writer'].buffer_writer.tell()
+                            nrecs = max(len([end for end in ends if end <= room]), 1)
+                            data, ends = data[:ends[nrecs - 1]], ends[:nrecs]
+                        self._appendblocks(ent, msglist[:nrecs], data, ends)
+                        msglist = msglist[nrecs:]
+                        now = time.time()
+                        ent['records'] += nrecs
+                        if acks and log in acks and not msglist:
+                            ent['acks'].extend(acks[log])
+                        ent['lastused'] = now
+                        if ent['records'] >= self.flushRecords or \
+                                self._pending(ent) >= self.flushBytes:
+                            self._flush(ent, now)
+                        if capped and msglist or capped and \
+                                ent['file'].tell() + ent['writer'].buffer_writer.tell() >= self.maxFileSize:
+                            self._close(log, ent)
+                    finally:
+                        ent['lock'].release()
+                metrics.writetime.observe(time.time() - start, (os.path.basename(log),))
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+
+        self._notifydurable()
+
+    def maintain(self):
+        """Flush day files that waited too long and close idle ones."""
+        try:
+            for log, ent in self._entries():
+                ent['lock'].acquire()
+                try:
+                    if ent['closed']:
+                        continue
+                    now = time.time()
+                    if now - ent['lastused'] >= self.idleTimeout:
+                        self._close(log, ent)
+                    elif now - ent['lastflush'] >= self.flushSeconds:
+                        self._flush(ent, now)
+                finally:
+                    ent['lock'].release()
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+
+        self._notifydurable()
+
+    def close(self):
+        try:
+            for log, ent in self._entries():
+                ent['lock'].acquire()
+                try:
+                    if not ent['closed']:
+                        self._close(log, ent)
+                finally:
+                    ent['lock'].release()
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+
+        self._notifydurable()
+
+    def sync(self):
+        """Group commit: fsync every day file flushed since last sync and
+           pass messages held in them to ondurable. Duplicated descriptors
+           are fsynced without holding locks of day files."""
+        self._lock.acquire()
+        self._unsynced = 0
+        self._lastsync = time.time()
+        self._lock.release()
+        fds, tokens = [], []
+        try:
+            for log, ent in self._entries():
+                ent['lock'].acquire()
+                try:
+                    if ent['closed'] or not ent['dirty']:
+                        continue
+                    fds.append(os.dup(ent['file'].fileno()))
+                    tokens.extend(ent['syncacks'])
+                    ent['syncacks'], ent['dirty'] = [], False
+                finally:
+                    ent['lock'].release()
+
+            if fds:
+                start = time.time()
+                for fd in fds:
+                    os.fsync(fd)
+                dur = time.time() - start
+                self._lock.acquire()
+                self.nsyncs += 1
+                self.syncsum += dur
+                if dur > self.syncmax:
+                    self.syncmax = dur
+                self._lock.release()
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+        self._adddurable(tokens)
+        self._notifydurable()
 
-            for m in msglist:
-                writer.append(m)
+    def _syncdue(self, now):
+        if self._syncwanted.isSet():
+            return True
+        if self.fsyncPolicy == 'interval':
+            return now - self._lastsync >= self.fsyncInterval
+        elif self.fsyncPolicy == 'records':
+            # do not hold back acknowledges of slow trickle of messages
+            return now - self._lastsync >= self.flushSeconds
+        return False
+
+    def _deferflush(self):
+        try:
+            self._flushloop()
+        except SystemExit:
+            shutdown()
+
+    def _flushloop(self):
+        lastmaintain = time.time()
+        while not sh.eventterm.isSet():
+            wait = 1.0
+            if self.fsyncPolicy == 'interval':
+                wait = min(wait, max(self._lastsync + self.fsyncInterval - time.time(), 0.001))
+            self._syncwanted.wait(wait)
+            if sh.eventterm.isSet():
+                break
+            now = time.time()
+            if now - lastmaintain >= 1.0:
+                self.maintain()
+                if self.onmaintain:
+                    self.onmaintain()
+                lastmaintain = now
+            if self._syncdue(now):
+                self._syncwanted.clear()
+                self.sync()
+        self.close()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return 'Flushed %i blocks, avg flush %.4f s, max flush %.4f s, fsync policy %s, %i group fsyncs, avg fsync %.4f s, max fsync %.4f s' % \
+                (self.nflushes, self.flushsum/self.nflushes if self.nflushes else 0.0, self.flushmax,
+                 self.fsyncPolicy, self.nsyncs, self.syncsum/self.nsyncs if self.nsyncs else 0.0, self.syncmax)
+        finally:
+            self._lock.release()
 
-            writer.close()
-            avroFile.close()
+
+class TextWriterPool:
+    """Keeps PLAINTEXT and WRONGFORMAT files open with lines buffered in
+       memory. Buffers are written out and files closed by the same
+       FlushEvery* and IdleFileTimeout thresholds as Avro day files, and
+       fsynced on close unless FsyncPolicy is none. With gzip or zstd
+       PlaintextCompression every write out is one complete gzip member or
+       zstd frame, so file stays readable with zcat or zstdcat even if
+       consumer is killed between them."""
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+        self.nflushes, self.nbytes = 0, 0
+        self.compression = None
+        self.load()
+
+    def load(self):
+        flushrecords = sh.ConsumerConf.get_option('OutputFlushEveryRecords'.lower(), optional=True)
+        flushbytes = sh.ConsumerConf.get_option('OutputFlushEveryBytes'.lower(), optional=True)
+        flushsecs = sh.ConsumerConf.get_option('OutputFlushEverySeconds'.lower(), optional=True)
+        idletimeout = sh.ConsumerConf.get_option('OutputIdleFileTimeout'.lower(), optional=True)
+        policy = sh.ConsumerConf.get_option('OutputFsyncPolicy'.lower(), optional=True)
+        compression = sh.ConsumerConf.get_option('OutputPlaintextCompression'.lower(), optional=True)
+        self.flushRecords = flushrecords if flushrecords is not None else defaultFlushEveryRecords
+        self.flushBytes = flushbytes if flushbytes is not None else defaultFlushEveryBytes
+        self.flushSeconds = flushsecs if flushsecs is not None else defaultFlushEverySeconds
+        self.idleTimeout = idletimeout if idletimeout is not None else defaultIdleFileTimeout
+        self.fsyncPolicy = policy.lower() if policy else defaultFsyncPolicy
+        compression = compression.lower() if compression else defaultPlaintextCompression
+        if compression != self.compression:
+            self.close()
+        self.compression = compression
+        self.extension = PTXTCOMPRESSIONS[self.compression]
+        self._zstd = zstandard.ZstdCompressor(level=zstdLevel) if self.compression == 'zstd' else None
+
+    def _frame(self, data):
+        if self.compression == 'gzip':
+            compressor = zlib.compressobj(gzipLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+        elif self.compression == 'zstd':
+            return self._zstd.compress(data)
+        return data
+
+    def _entry(self, filename):
+        self._lock.acquire()
+        try:
+            ent = self._files.get(filename)
+            if ent is None:
+                now = time.time()
+                ent = {'lock': threading.Lock(), 'closed': False, 'file': None,
+                       'buf': [], 'bytes': 0, 'records': 0, 'lastflush': now, 'lastused': now}
+                self._files[filename] = ent
+            return ent
+        finally:
+            self._lock.release()
+
+    def _flush(self, filename, ent, now):
+        if ent['buf']:
+            if ent['file'] is None:
+                ent['file'] = open(filename, 'ab')
+            data = self._frame(''.join(ent['buf']))
+            ent['file'].write(data)
+            ent['file'].flush()
+            ent['buf'], ent['bytes'], ent['records'] = [], 0, 0
+            metrics.writtenbytes.inc(len(data), PLAINTEXTLABELS)
+            self._lock.acquire()
+            self.nflushes += 1
+            self.nbytes += len(data)
+            self._lock.release()
+        ent['lastflush'] = now
+
+    def _close(self, filename, ent):
+        ent['closed'] = True
+        try:
+            self._flush(filename, ent, time.time())
+            if ent['file'] is not None:
+                if self.fsyncPolicy != 'none':
+                    os.fsync(ent['file'].fileno())
+                ent['file'].close()
+        finally:
+            self._lock.acquire()
+            try:
+                if self._files.get(filename) is ent:
+                    del self._files[filename]
+            finally:
+                self._lock.release()
+
+    def _entries(self):
+        self._lock.acquire()
+        try:
+            return self._files.items()
+        finally:
+            self._lock.release()
+
+    def append(self, filename, lines):
+        """Buffer list of lines for filename, written out once thresholds
+           are reached."""
+        try:
+            while True:
+                ent = self._entry(filename)
+                ent['lock'].acquire()
+                try:
+                    if ent['closed']:
+                        continue
+                    now = time.time()
+                    ent['buf'].extend(lines)
+                    ent['bytes'] += sum([len(line) for line in lines])
+                    ent['records'] += len(lines)
+                    ent['lastused'] = now
+                    if ent['records'] >= self.flushRecords or ent['bytes'] >= self.flushBytes:
+                        self._flush(filename, ent, now)
+                    break
+                finally:
+                    ent['lock'].release()
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+            raise SystemExit(1)
+
+    def maintain(self):
+        try:
+            for filename, ent in self._entries():
+                ent['lock'].acquire()
+                try:
+                    if ent['closed']:
+                        continue
+                    now = time.time()
+                    if now - ent['lastused'] >= self.idleTimeout:
+                        self._close(filename, ent)
+                    elif now - ent['lastflush'] >= self.flushSeconds:
+                        self._flush(filename, ent, now)
+                finally:
+                    ent['lock'].release()
 
         except (IOError, OSError) as e:
             sh.Logger.error(e)
             raise SystemExit(1)
 
+    def close(self):
+        try:
+            for filename, ent in self._entries():
+                ent['lock'].acquire()
+                try:
+                    if not ent['closed']:
+                        self._close(filename, ent)
+                finally:
+                    ent['lock'].release()
+
+        except (IOError, OSError) as e:
+            sh.Logger.error(e)
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return 'Plaintext files open %i, %i writes, %i bytes written, compression %s' % \
+                (len(self._files), self.nflushes, self.nbytes, self.compression)
         finally:
-            sh.thlock.release()
+            self._lock.release()
 
-    def _is_validmsg(self, msgfields):
-        keys = set(msgfields.keys())
-        mandatory_fields = set(['serviceType', 'timestamp', 'hostName', 'metricName', 'metricStatus'])
 
-        if keys >= mandatory_fields:
+class MessageWriter:
+    def __init__(self, shard=0):
+        self.pool, self.textpool = None, None
+        self._outputs = None
+        self.shard = shard
+        self._names = {}
+        self.load()
+        self.textpool = TextWriterPool()
+        self.pool = AvroWriterPool()
+        self.pool.partitioned = self.partitioned
+        self.pool.onmaintain = self.textpool.maintain
+
+    def load(self):
+        self.dateFormat = '%Y-%m-%dT%H:%M:%SZ'
+        self.fileDirectory = sh.ConsumerConf.get_option('OutputDirectory'.lower())
+        self.filenameTemplate = sh.ConsumerConf.get_option('OutputFilename'.lower())
+        self.errorFilenameTemplate = sh.ConsumerConf.get_option('OutputErrorFilename'.lower())
+        self.txtOutput = sh.ConsumerConf.get_option('GeneralWritePlaintext'.lower())
+        self.pastDaysOk = sh.ConsumerConf.get_option('MsgRetentionPastDaysOk'.lower())
+        self.futureDaysOk = sh.ConsumerConf.get_option('MsgRetentionFutureDaysOk'.lower())
+        self.logOutAllowedTime = sh.ConsumerConf.get_option('GeneralLogMsgOutAllowedTime'.lower())
+        self.logWrongFormat = sh.ConsumerConf.get_option('GeneralLogWrongFormat'.lower())
+        templates = [self.filenameTemplate, self.errorFilenameTemplate]
+        self.partitioned = bool([t for t in templates if 'HOUR' in t or 'SEQ' in t])
+        self._window, self._windowExpires = None, 0
+        self._names = {}
+        outputs = (self.fileDirectory, self.filenameTemplate, self.errorFilenameTemplate)
+        if self.pool and outputs != self._outputs:
+            sh.Logger.info('Output directory or filenames changed, open files closed')
+            self.close()
+        self._outputs = outputs
+        if self.pool:
+            self.pool.load()
+            self.pool.partitioned = self.partitioned
+        if self.textpool:
+            self.textpool.load()
+
+    def close(self):
+        self.pool.close()
+        self.textpool.close()
+
+    def setDurableCallback(self, callback):
+        self.pool.ondurable = callback
+
+    def stats(self):
+        return self.pool.stats() + '\n' + self.textpool.stats()
+
+    def _cachedname(self, key, make):
+        """Filenames derived from templates are computed once per day or
+           hour they are used for."""
+        name = self._names.get(key)
+        if name is None:
+            if len(self._names) >= maxCachedNames:
+                self._names = {}
+            name = self._names[key] = make()
+        return name
+
+    def _write_to_ptxt(self, log, fieldslist, exten):
+        filename = self._cachedname((log, exten), lambda: '.'.join(log.replace('SEQ', '').split('.')[:-1]) +
+                                    '.%s%s' % (exten, self.textpool.extension))
+        self.textpool.append(filename, [jsondumps(fields) + '\n' for fields in fieldslist])
+
+    def _is_validmsg(self, result):
+        missing = result.missing()
+
+        if not missing:
             return True
         else:
-            sh.Logger.error('Message %s has no mandatory fields: %s' % (msgfields['message-id'],
-                                                                        str([e for e in mandatory_fields.difference(keys)])))
+            sh.Logger.error('Message %s has no mandatory fields: %s' % (result.msgid, str(missing)))
+            metrics.rejected.inc(labels=('missing_fields',))
             return False
 
+    def _acceptedwindow(self):
+        """Set of YYYY-MM-DD dates within retention period, computed once
+           per UTC day."""
+        if time.time() >= self._windowExpires:
+            nowTime = datetime.datetime.utcnow()
+            today = nowTime.date()
+            self._window = frozenset([str(today + datetime.timedelta(days=d))
+                                      for d in range(-self.pastDaysOk, self.futureDaysOk + 1)])
+            midnight = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time())
+            self._windowExpires = time.time() + (midnight - nowTime).total_seconds()
+        return self._window
+
     def _is_ininterval(self, msgid, timestamp, now):
+        # well formed timestamp within accepted dates needs no parsing,
+        # everything else takes the full parse path below
+        if timestamp[:10] in self._acceptedwindow() and len(timestamp) == 20 and \
+                TIMERE.match(timestamp, 10):
+            return True
+
         inint = False
 
         try:
@@ -180,6 +901,7 @@ class MessageWriter:
             nowTime = datetime.datetime.utcnow().date()
         except ValueError as e:
             sh.Logger.error('Message %s %s' % (msgid, e))
+            metrics.rejected.inc(labels=('bad_timestamp',))
             return inint
 
         timeDiff = nowTime - msgTime
@@ -189,30 +911,77 @@ class MessageWriter:
             inint = True
         elif timeDiff.days < 0 and -timeDiff.days <= self.futureDaysOk:
             inint = True
+        else:
+            metrics.rejected.inc(labels=('out_of_window',))
 
         return inint
 
     def writeMessage(self, fields):
-        now = datetime.datetime.utcnow().date()
-
-        if self._is_validmsg(fields):
-            if self._is_ininterval(fields['message-id'], fields['timestamp'], now):
-                filename = self.createLogFilename(fields['timestamp'][:10])
-                self._write_to_avro(filename, fields)
+        self.writeMessages([msgparser.MetricResult.fromfields(fields)])
+
+    def _fullfields(self, result, frame):
+        return result.fields if result.fields is not None else msgparser.parsefull(*frame)
+
+    def writeFrames(self, frames, tokens=None):
+        """Parse raw (headers, body) frames and write them."""
+        results = []
+        for headers, message in frames:
+            start = time.time()
+            results.append(msgparser.parse(headers, message))
+            metrics.parsetime.observe(time.time() - start)
+        self.writeMessages(results, tokens, frames)
+
+    def writeMessages(self, batch, tokens=None, frames=None):
+        """Validate and classify batch of MetricResults and group them by
+           destination file so that each file is appended once. tokens, if
+           given, are passed to durable callback once the message is
+           written. frames are raw (headers, body) of messages in batch
+           used to get all fields for plaintext and WRONGFORMAT output."""
+        utcnow = datetime.datetime.utcnow()
+        now, nowts = utcnow.date(), utcnow.strftime(self.dateFormat)
+        avrofiles, ptxtfiles, acks, done = {}, {}, {}, []
+        tokens = tokens or [None] * len(batch)
+        frames = frames or [None] * len(batch)
+
+        for result, token, frame in zip(batch, tokens, frames):
+            if self._is_validmsg(result):
+                if self._is_ininterval(result.msgid, result.timestamp, now):
+                    filename = self.createLogFilename(result.timestamp)
+                elif self.logOutAllowedTime:
+                    filename = self.createErrorLogFilename(nowts)
+                else:
+                    done.append(token)
+                    continue
+                avrofiles.setdefault(filename, []).extend(result.services())
+                acks.setdefault(filename, []).append(token)
                 if self.txtOutput:
-                    self._write_to_ptxt(filename, fields, 'PLAINTEXT')
-
-            elif self.logOutAllowedTime:
-                filename = self.createErrorLogFilename(str(now))
-                self._write_to_avro(filename, fields)
-                if self.txtOutput:
-                    self._write_to_ptxt(filename, fields, 'PLAINTEXT')
-        elif self.logWrongFormat:
-            filename = self.createErrorLogFilename(str(now))
-            self._write_to_ptxt(filename, fields, 'WRONGFORMAT')
+                    ptxtfiles.setdefault((filename, 'PLAINTEXT'), []).append(self._fullfields(result, frame))
+            else:
+                if self.logWrongFormat:
+                    filename = self.createErrorLogFilename(nowts)
+                    ptxtfiles.setdefault((filename, 'WRONGFORMAT'), []).append(self._fullfields(result, frame))
+                done.append(token)
+
+        if avrofiles:
+            self.pool.append(avrofiles, acks)
+        for (filename, exten), fieldslist in ptxtfiles.items():
+            self._write_to_ptxt(filename, fieldslist, exten)
+        if self.pool.ondurable and any(done):
+            self.pool.ondurable(done)
+
+    def _expand(self, template, timestamp):
+        """DATE and HOUR placeholders replaced from YYYY-MM-DDTHH:MM:SSZ
+           timestamp, SHARD with number of encoder worker, SEQ is resolved
+           when file is opened."""
+        filename = template.replace('DATE', timestamp[:10])
+        if 'HOUR' in filename:
+            filename = filename.replace('HOUR', timestamp[11:13])
+        if 'SHARD' in filename:
+            filename = filename.replace('SHARD', str(self.shard))
+        return self.fileDirectory + filename
 
     def createLogFilename(self, timestamp):
-        return self.fileDirectory + self.filenameTemplate.replace('DATE', timestamp)
+        return self._cachedname((False, timestamp[:13]), lambda: self._expand(self.filenameTemplate, timestamp))
 
     def createErrorLogFilename(self, timestamp):
-        return self.fileDirectory + self.errorFilenameTemplate.replace('DATE', timestamp)
+        return self._cachedname((True, timestamp[:13]), lambda: self._expand(self.errorFilenameTemplate, timestamp))
@@ -0,0 +1,61 @@
+"""Tests of config parsing, run from source tree with
+   python -m unittest discover tests"""
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import common
+from argo_egi_consumer.config import ConsumerConf
+from argo_egi_consumer.shared import SingletonShared as Shared
+
+class ParseTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.confpath = os.path.join(self.outdir, 'consumer.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def write(self, replace):
+        conf = open(os.path.join(common.ETCDIR, 'consumer.conf')).read()
+        conf = conf.replace('/etc/argo-egi-consumer', common.ETCDIR)
+        for old, new in replace:
+            self.assertTrue(old in conf)
+            conf = conf.replace(old, new)
+        open(self.confpath, 'w').write(conf)
+
+    def testInvalidWithoutLogger(self):
+        # daemon parses config before it sets up logger
+        logger = getattr(Shared, 'Logger', None)
+        if logger:
+            del Shared.Logger
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.write([('FsyncPolicy = none', 'FsyncPolicy = bogus'),
+                        ('Server2 = broker-prod1.argo.grnet.gr:6163', 'Server2 = broker-prod1.argo.grnet.gr')])
+            self.assertRaises(SystemExit, ConsumerConf(self.confpath).parse)
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            if logger:
+                Shared().seta('Logger', logger)
+        self.assertTrue('OutputFsyncPolicy should be one of' in errors)
+        self.assertTrue('Port should be specified for broker-prod1.argo.grnet.gr' in errors)
+
+    def testInvalidReloadKeepsSnapshot(self):
+        Shared().seta('Logger', common.Logger())
+        self.write([])
+        conf = ConsumerConf(self.confpath)
+        self.assertTrue(conf.parse())
+        old = conf.snapshot()
+        self.write([('FsyncPolicy = none', 'FsyncPolicy = bogus')])
+        self.assertFalse(conf.parse())
+        self.assertTrue(conf.snapshot() is old)
+
+if __name__ == '__main__':
+    unittest.main()
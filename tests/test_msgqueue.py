@@ -0,0 +1,74 @@
+"""Tests of message queue, run from source tree with
+   python -m unittest discover tests"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import common
+# modules copy shared state on import, so they are imported before any setup
+from argo_egi_consumer.reader import MessagePipeline, MessageAcker
+
+class FakeConn:
+    def __init__(self):
+        self.acked = []
+
+    def ack(self, headers):
+        self.acked.append(headers['message-id'])
+
+class SpillAckTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline:
+            self.close()
+        shutil.rmtree(self.outdir)
+
+    def close(self):
+        self.sh.eventterm.set()
+        self.pipeline.close()
+        self.pipeline.writer.pool.th.join()
+        self.pipeline = None
+
+    def spillAndAck(self, ackmode):
+        self.sh = common.setup(self.outdir, {'Queue': {'Capacity': 2, 'FullPolicy': 'spill',
+                                                       'SpillFile': os.path.join(self.outdir, 'queue.spill')},
+                                             'STOMP': {'AckMode': ackmode},
+                                             'Spool': {'File': None}, 'Dedup': {'Policy': 'off'}})
+        self.pipeline = MessagePipeline()
+        acker = MessageAcker(0)
+        acker.setconn(FakeConn())
+        self.pipeline.ackers[0] = acker
+        # writers wait while messages are put, so the queue overflows
+        self.pipeline._gate.acquire()
+        self.pipeline._paused = True
+        self.pipeline._gate.release()
+        ids = []
+        for headers, body in common.messages(6, 128):
+            headers = dict(headers, subscription='0')
+            ids.append(headers['message-id'])
+            self.pipeline.put(headers, body, acker.received(headers))
+        self.assertTrue(self.pipeline.queue.nspilled > 0)
+        self.pipeline._gate.acquire()
+        self.pipeline._paused = False
+        self.pipeline._gate.notifyAll()
+        self.pipeline._gate.release()
+        self.close()
+        return ids, acker
+
+    def testClientAckAfterSpill(self):
+        ids, acker = self.spillAndAck('client')
+        self.assertEqual([len(p) for p in acker._pending.values()], [0])
+        self.assertEqual(acker.conn.acked[-1], ids[-1])
+
+    def testClientIndividualAckAfterSpill(self):
+        ids, acker = self.spillAndAck('client-individual')
+        self.assertEqual(sorted(acker.conn.acked), sorted(ids))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""Tests of message reader, run from source tree with
+   python -m unittest discover tests"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+import common
+# modules copy shared state on import, so they are imported before any setup
+from argo_egi_consumer.reader import MessageReader
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def testRollbackFailureStopsReader(self):
+        sh = common.setup(self.outdir, {'Brokers': {'Server1': '127.0.0.1:1', 'Server2': None},
+                                        'Spool': {'File': None}})
+        reader = MessageReader()
+        confpath = os.path.join(self.outdir, 'consumer.conf')
+        conf = open(confpath).read()
+        open(confpath, 'w').write(conf.replace('\nCapacity = 10000\n', '\nCapacity = 20000\n'))
+
+        def failingapply():
+            raise SystemExit(1)
+        reader._apply = failingapply
+        reader.reload()
+        th = threading.Thread(target=reader.run)
+        th.start()
+        th.join(10)
+        self.assertFalse(th.isAlive())
+        self.assertTrue(sh.eventterm.isSet())
+        reader.th.join(10)
+        self.assertFalse(reader.th.isAlive())
+        self.assertTrue(reader.pipeline.queue.isclosed())
+        reader.pipeline.writer.pool.th.join()
+
+if __name__ == '__main__':
+    unittest.main()